@@ -31,10 +31,23 @@ def _args_adress():
                         dest='top')
     parser.add_argument('--node_grid')
     parser.add_argument('--cell_grid')
-    parser.add_argument('--skin', type=float, default=0.16,
-                        help='Skin value for Verlet list')
+    parser.add_argument('--skin', type=float, default=None,
+                        help='Skin value for Verlet list (by default from the tuning cache or 0.16)')
     parser.add_argument('--run', type=int, default=10000,
                         help='Number of simulation steps')
+    parser.add_argument('--autotune', default=False, type=ast.literal_eval,
+                        help='If set to true then the fastest skin is selected by short trial runs')
+    parser.add_argument('--autotune_skins', default='0.1,0.16,0.2,0.25,0.3',
+                        help='Candidate skins for --autotune')
+    parser.add_argument('--autotune_steps', default=500, type=int, help='Steps of every --autotune trial')
+    parser.add_argument('--autotune_repeats', default=3, type=int,
+                        help='Number of --autotune trials of every skin, the median time is used')
+    parser.add_argument('--autotune_cache', default='.adresslab_tuning.json',
+                        help='Cache of tuned parameters, used by later runs of the same class of system')
+    parser.add_argument('--adaptive_skin', default=False, type=ast.literal_eval,
+                        help='If set to true then the skin is adjusted during the run')
+    parser.add_argument('--skin_min', default=0.05, type=float, help='Lower bound of --adaptive_skin')
+    parser.add_argument('--skin_max', default=0.5, type=float, help='Upper bound of --adaptive_skin')
     parser.add_argument('--int_step', default=1000, type=int, help='Steps in integrator loop')
     parser.add_argument('--dt', default=0.001, type=float,
                         help='Integrator time step')
@@ -44,6 +57,10 @@ def _args_adress():
                         default='sim', type=str,
                         help='Prefix for output files')
     parser.add_argument('--energy_collect', default=1000, help='How often collect energy terms', type=int)
+    parser.add_argument('--heartbeat_interval', default=10, type=int,
+                        help='Rewrite the status file every n integrator loops (0 - disabled)')
+    parser.add_argument('--heartbeat_file', default=None,
+                        help='The JSON status file, by default <output_prefix>_<rng_seed>_heartbeat.json')
     parser.add_argument('--debug', default=None)
 
     trajectory_group = parser.add_argument_group('Trajectory')
@@ -90,6 +107,8 @@ def _args_adress():
     interactions_group.add_argument('--table_groups', default=None,
                         help='Name of CG groups to read from tables')
     interactions_group.add_argument('--exclusion_list', default=None, help='The exclusion list')
+    interactions_group.add_argument('--table_tolerance', default=None, type=float,
+                        help='If set then the tables are resampled on the coarsest grid with this error')
     interactions_group.add_argument(
         '--tabletf',
         default=None,
@@ -105,6 +124,13 @@ def _args_adress():
         help='Where is the centre of explicit region. Format: "box_centre" - for box centre; x,y,z - specific position.')
     adress_group.add_argument('--adress_use_sphere', help='If True then spherical AdResS is used', default=False,
                               type=ast.literal_eval)
+    adress_group.add_argument(
+        '--balance_node_grid', default=False, type=ast.literal_eval,
+        help='If set to true then the node grid is chosen to balance the cost of explicit and CG regions')
+    adress_group.add_argument(
+        '--cg_cutoff', default=None,
+        help=('Cut-off of CG tabulated interactions. By default the same as the atomistic cut-off; '
+              '"auto" - the range of the tables.'))
 
     compute_tf = parser.add_argument_group('Thermodynamic force calculation')
     compute_tf.add_argument(
@@ -112,9 +138,41 @@ def _args_adress():
         default=False,
         help='If set to true then thermodynamic force will be calculated', type=ast.literal_eval)
     compute_tf.add_argument('--tf_prefactor', help='Prefactor', type=float, default=1.0)
+    compute_tf.add_argument('--tf_update', default='simple', choices=('simple', 'adaptive', 'secant', 'anderson'),
+                            help=('Update scheme of the thermodynamic force: simple - constant prefactor, '
+                                  'adaptive - adapted prefactor, secant - Barzilai-Borwein step, '
+                                  'anderson - Anderson mixing'))
+    compute_tf.add_argument('--tf_history', default=5, type=int,
+                            help='Number of previous steps used by the anderson update')
     compute_tf.add_argument('--tf_max_steps', default=100, type=int)
     compute_tf.add_argument('--tf_initial_table', default=None)
     compute_tf.add_argument('--tf_initial_step', default=1, type=int)
+    compute_tf.add_argument('--tf_save_tables', default=False, type=ast.literal_eval,
+                            help=('If set to true then the text tables of every step are saved, otherwise only '
+                                  'the history file (see export_tf_history)'))
+    compute_tf.add_argument('--tf_tolerance', default=None, type=float,
+                            help='Stop when the max. relative deviation of the density is below it')
+    compute_tf.add_argument('--tf_force_tolerance', default=None, type=float,
+                            help='Stop when the max. change of the thermodynamic force is below it')
+    compute_tf.add_argument('--tf_replicas', default=1, type=int,
+                            help=('Number of independent replicas (separate runs with different --rng_seed) that '
+                                  'pool the density profiles after every step'))
+    compute_tf.add_argument('--tf_replica_id', default=0, type=int, help='Id of this replica (0..tf_replicas-1)')
+    compute_tf.add_argument('--tf_exchange_dir', default='tf_replicas',
+                            help='Directory shared by the replicas to exchange the density profiles')
+    compute_tf.add_argument('--tf_run_id', default=None,
+                            help='Id of the run, the same for all replicas (by default --output_prefix)')
+    compute_tf.add_argument('--tf_exchange_timeout', default=3600.0, type=float,
+                            help='Stop if other replica does not save its profiles within this time (seconds)')
+    compute_tf.add_argument('--tf_sample_stride', default=None, type=int,
+                            help='Sample the density profile every n steps (by default every --int_step)')
+    compute_tf.add_argument('--tf_block_size', default=10, type=int,
+                            help=('Number of density samples in a block used for the error estimate, the error '
+                                  'is known after two blocks'))
+    compute_tf.add_argument('--tf_adaptive_run', default=False, type=ast.literal_eval,
+                            help=('If set to true then every step runs (at most --run steps) until the statistical '
+                                  'error of the density is below half of the current deviation. The error needs '
+                                  'two blocks (--tf_block_size) of samples (--tf_sample_stride)'))
 
     return parser
 
@@ -127,10 +185,19 @@ def _args_md():
                         dest='top')
     parser.add_argument('--node_grid')
     parser.add_argument('--cell_grid')
-    parser.add_argument('--skin', type=float, default=0.16,
-                        help='Skin value for Verlet list')
+    parser.add_argument('--skin', type=float, default=None,
+                        help='Skin value for Verlet list (by default from the tuning cache or 0.16)')
     parser.add_argument('--run', type=int, default=10000,
                         help='Number of simulation steps')
+    parser.add_argument('--autotune', default=False, type=ast.literal_eval,
+                        help='If set to true then the fastest skin is selected by short trial runs')
+    parser.add_argument('--autotune_skins', default='0.1,0.16,0.2,0.25,0.3',
+                        help='Candidate skins for --autotune')
+    parser.add_argument('--autotune_steps', default=500, type=int, help='Steps of every --autotune trial')
+    parser.add_argument('--autotune_repeats', default=3, type=int,
+                        help='Number of --autotune trials of every skin, the median time is used')
+    parser.add_argument('--autotune_cache', default='.adresslab_tuning.json',
+                        help='Cache of tuned parameters, used by later runs of the same class of system')
     parser.add_argument('--int_step', default=1000, type=int, help='Steps in integrator loop')
     parser.add_argument('--dt', default=0.001, type=float,
                         help='Integrator time step')
@@ -140,6 +207,10 @@ def _args_md():
                         default='sim', type=str,
                         help='Prefix for output files')
     parser.add_argument('--energy_collect', default=1000, help='How often collect energy terms', type=int)
+    parser.add_argument('--heartbeat_interval', default=10, type=int,
+                        help='Rewrite the status file every n integrator loops (0 - disabled)')
+    parser.add_argument('--heartbeat_file', default=None,
+                        help='The JSON status file, by default <output_prefix>_<rng_seed>_heartbeat.json')
 
     trajectory_group = parser.add_argument_group('Trajectory')
     trajectory_group.add_argument('--trj_collect', default=1000, help='How often to store trajectory', type=int)
@@ -185,6 +256,8 @@ def _args_md():
     interactions_group.add_argument('--table_groups', default=None,
                         help='Name of CG groups to read from tables')
     interactions_group.add_argument('--exclusion_list', default=None, help='The exclusion list')
+    interactions_group.add_argument('--table_tolerance', default=None, type=float,
+                        help='If set then the tables are resampled on the coarsest grid with this error')
     interactions_group.add_argument(
         '--tabletf',
         default=None,
@@ -193,3 +266,51 @@ def _args_md():
               ' specifying the CG type.'))
 
     return parser
+
+
+def _args_optimize():
+    parser = general_tools.MyArgParser(description='Predicts the performance of AdResS setups',
+                                       fromfile_prefix_chars='@')
+    parser.add_argument('--conf', required=True, help='Input .gro coordinate file')
+    parser.add_argument('--top', '--topology', required=True, help='Topology file',
+                        dest='top')
+    parser.add_argument('--benchmarks', required=True, nargs='+',
+                        help=('Performance reports (JSON) of short runs of the same system with different '
+                              'regions and number of CPUs'))
+    parser.add_argument('--cutoff', default=None, type=float,
+                        help='Cut-off of atomistic interactions, by default the one of the benchmarks')
+    parser.add_argument('--cg_cutoff', default=None, type=float,
+                        help='Cut-off of CG interactions, by default the one of the benchmarks')
+    parser.add_argument('--skin', type=float, default=None,
+                        help='Skin value for Verlet list, by default the one of the benchmarks')
+    parser.add_argument('--dt', default=0.001, type=float, help='Integrator time step')
+    parser.add_argument('--adress_centre', default='box_centre',
+                        help='Define the centre of AdResS region, by default it is a box centre')
+    parser.add_argument('--adress_use_sphere', default=False, type=ast.literal_eval,
+                        help='If set to true then the AdResS region is spherical')
+    parser.add_argument('--min_adress_ex', required=True, type=float,
+                        help='The smallest acceptable size of explicit region')
+    parser.add_argument('--max_adress_ex', default=None, type=float,
+                        help='The largest size of explicit region to check (by default the half of the box)')
+    parser.add_argument('--adress_ex_step', default=0.1, type=float)
+    parser.add_argument('--adress_hy', default='1.0', help='Comma separated widths of hybrid region to check')
+    parser.add_argument('--num_cpus', default='1,2,4,8,16,32,64',
+                        help='Comma separated number of CPUs to check')
+    parser.add_argument('--min_ns_per_day', default=0.0, type=float,
+                        help='Skip the setups slower than this')
+    parser.add_argument('--output', default=None, help='Save all predictions to this CSV file')
+
+    return parser
+
+
+def _args_export_tf_history():
+    parser = general_tools.MyArgParser(description='Exports the history of thermodynamic force calculation',
+                                       fromfile_prefix_chars='@')
+    parser.add_argument('history', help='The history file (*_tf_history.tfh)')
+    parser.add_argument('--output_prefix', default=None,
+                        help='Prefix of the exported files, by default the name of history file without suffix')
+    parser.add_argument('--steps', default=None, help='Comma separated steps to export, by default all')
+    parser.add_argument('--list', default=False, type=ast.literal_eval,
+                        help='If set to true then only the records are listed')
+
+    return parser
@@ -19,6 +19,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import collections
+import json
 import logging
 import os
 import re
@@ -1254,3 +1255,170 @@ def read_topology(file_name, settings):
         }
     file_suffix = file_name.split('.')[-1]
     return file_suffix_class[file_suffix](file_name, settings)
+
+
+def write_exclusions(file_name, exclusions, stamp):
+    """Writes the exclusion list as int32 .npy array.
+
+    Args:
+      file_name: The output .npy file.
+      exclusions: The list of excluded pairs.
+      stamp: The hash of topology, saved in the file_name.sha1 file.
+    """
+    exclusions = numpy.asarray(exclusions, dtype=numpy.int32).reshape(-1, 2)
+    logger.info('Writing exclusion list %s', file_name)
+    with open(file_name, 'wb') as output_file:
+        numpy.save(output_file, exclusions)
+    with open('{}.sha1'.format(file_name), 'w') as stamp_file:
+        stamp_file.write(stamp)
+
+
+def read_exclusions(file_name, stamp=None):
+    """Reads the exclusion list written by write_exclusions.
+
+    Args:
+      file_name: The input .npy file.
+      stamp: The hash of topology, if set then it has to match the saved one.
+
+    Returns:
+      The memory-mapped (N, 2) array or None if the file does not exist or is stale.
+    """
+    if not os.path.exists(file_name):
+        return None
+    if stamp is not None:
+        stamp_file_name = '{}.sha1'.format(file_name)
+        if not os.path.exists(stamp_file_name):
+            logger.warning('Exclusion list %s without stamp, rebuilding', file_name)
+            return None
+        with open(stamp_file_name, 'r') as stamp_file:
+            if stamp_file.read().strip() != stamp:
+                logger.warning('Exclusion list %s is stale, rebuilding', file_name)
+                return None
+    logger.info('Reading exclusion list %s', file_name)
+    return numpy.load(file_name, mmap_mode='r')
+
+
+def backup_file(file_name):
+    """Renames the existing file to file_name.N, with the first free N.
+
+    Returns:
+      The new name of the file or None if the file does not exist.
+    """
+    if not os.path.exists(file_name):
+        return None
+    backup_id = 1
+    while os.path.exists('{}.{}'.format(file_name, backup_id)):
+        backup_id += 1
+    backup_file_name = '{}.{}'.format(file_name, backup_id)
+    os.rename(file_name, backup_file_name)
+    return backup_file_name
+
+
+def append_tf_history(file_name, arrays, **metadata):
+    """Appends a step of thermodynamic force calculation to the history file (.tfh).
+
+    The file is a stream of records, not a single .npy file. Every record is the JSON header
+    (metadata and the names of arrays) saved as .npy array of bytes, followed by the arrays
+    saved as .npy. Use read_tf_history to read it.
+
+    Args:
+      file_name: The history file.
+      arrays: The dictionary with the name and the array.
+      metadata: The metadata of the step, e.g. step and name of the profile.
+    """
+    header = dict(metadata, arrays=sorted(arrays))
+    with open(file_name, 'ab') as output_file:
+        numpy.save(output_file, numpy.frombuffer(json.dumps(header).encode('utf-8'), dtype=numpy.uint8))
+        for array_name in header['arrays']:
+            numpy.save(output_file, numpy.asarray(arrays[array_name], dtype=numpy.float64))
+
+
+def read_tf_history(file_name):
+    """Reads the history file written by append_tf_history.
+
+    Returns:
+      The list of records, dictionaries with the metadata and the arrays.
+    """
+    records = []
+    file_size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as input_file:
+        while input_file.tell() < file_size:
+            try:
+                record = json.loads(numpy.load(input_file).tobytes().decode('utf-8'))
+                for array_name in record['arrays']:
+                    record[array_name] = numpy.load(input_file)
+            except (IOError, ValueError):
+                logger.warning('Truncated record in %s after %d records', file_name, len(records))
+                break
+            records.append(record)
+    return records
+
+
+def export_tf_history(file_name, output_prefix, steps=None):
+    """Writes the history as *_xdensity_s{N}.csv, *_th_s{N}.xvg and *_th_s{N}_raw.xvg files.
+
+    A file is written only if the record has all its columns, e.g. the initial table
+    has only the *_th_s{N}.xvg file.
+
+    Args:
+      file_name: The history file.
+      output_prefix: The prefix of the files, e.g. sim_1234.
+      steps: The list of steps to export, by default all.
+
+    Returns:
+      The list of written files.
+    """
+    written_files = []
+    for record in read_tf_history(file_name):
+        if steps is not None and record['step'] not in steps:
+            continue
+        name_suffix = '' if record.get('name') is None else '_{}'.format(record['name'])
+        output_files = [
+            ('{}_xdensity{}_s{}.csv', ('x_r', 'xdensity')),
+            ('{}_th{}_s{}.xvg', ('tf_x', 'rho_s', 'th_force')),
+            ('{}_th{}_s{}_raw.xvg', ('tf_x', 'rho', 'rho_s', 'th_force', 'drho_s', 'rho_error'))]
+        for output_pattern, columns in output_files:
+            if not all(c in record for c in columns):
+                continue
+            output_file = output_pattern.format(output_prefix, name_suffix, record['step'])
+            numpy.savetxt(output_file, numpy.column_stack([record[c] for c in columns]))
+            written_files.append(output_file)
+    return written_files
+
+
+def read_tuning_cache(file_name, key):
+    """Reads the tuned parameters of the system class key from the JSON cache.
+
+    Returns:
+      The dictionary with the parameters or None if not found.
+    """
+    if not os.path.exists(file_name):
+        return None
+    with open(file_name, 'r') as cache_file:
+        try:
+            cache = json.load(cache_file)
+        except ValueError:
+            logger.warning('Broken tuning cache %s', file_name)
+            return None
+    return cache.get(key)
+
+
+def write_tuning_cache(file_name, key, value):
+    """Stores the tuned parameters of the system class key in the JSON cache."""
+    cache = {}
+    if os.path.exists(file_name):
+        with open(file_name, 'r') as cache_file:
+            try:
+                cache = json.load(cache_file)
+            except ValueError:
+                logger.warning('Broken tuning cache %s, overwriting', file_name)
+    cache[key] = value
+    write_json(file_name, cache)
+
+
+def write_json(file_name, data):
+    """Writes the data to the JSON file, the file is replaced atomically."""
+    tmp_file_name = '{}.{}.tmp'.format(file_name, os.getpid())
+    with open(tmp_file_name, 'w') as json_file:
+        json.dump(data, json_file, indent=2, sort_keys=True)
+    os.rename(tmp_file_name, file_name)
@@ -24,6 +24,8 @@
 # file.
 
 from collections import namedtuple, defaultdict
+import hashlib
+import numpy
 from topology_helper import *
 
 __doc__ = """This Python module allows one to use GROMACS data files as the
@@ -55,7 +57,8 @@ GromacsSystem = namedtuple(
         'pairtypes',
         'pairtypeparams',
         'nonbond_params',
-        'exclusions'
+        'exclusions',
+        'virtual_sites'
     ])
 
 
@@ -79,6 +82,7 @@ def read(top_file="", doRegularExcl=True, defines=None):
     dihedrals = {}  # same...
     pairs_1_4 = {}  # dict: key pairtype value: tuple of pairs
     exclusions = []  # list of atom pairs no considered in non-bonded interactions
+    virtual_sites = []  # list of (site, i, j, k, a, b) from [ virtual_sites3 ] section
 
     defaults = {}  # gromacs default values
     atomtypeparams = {}  # a dict: key atomtypeid , value : class storing actual parameters of each type e.g. c6, c12, etc..
@@ -421,6 +425,8 @@ def read(top_file="", doRegularExcl=True, defines=None):
                                    atomtypeparams, pairs_1_4,
                                    num_atoms_molecule, num_molecule_copies,
                                    molstartindex)
+            virtual_sites = storeVirtualSites(f, virtual_sites, num_atoms_molecule,
+                                              num_molecule_copies, molstartindex)
             if doRegularExcl:
                 storeExclusions(exclusions, nrexcl, bonds)
 
@@ -453,16 +459,24 @@ def read(top_file="", doRegularExcl=True, defines=None):
     print 'Found {} 1-4 pair type parameters'.format(len(use_pairtypeparams))
     print 'Found {} 1-4 pairs'.format(len(pairs_1_4))
     print 'Found {} bond exclusions'.format(len(exclusions))
+    print 'Found {} virtual sites'.format(len(virtual_sites))
 
     gromacs_system = GromacsSystem(
         defaults, types, masses, charges, res_ids, use_atomtypeparams,
         bonds, bondtypeparams, angles, angletypeparams,
         dihedrals, dihedraltypeparams, pairs_1_4, use_pairtypeparams,
-        use_nonbond_params, exclusions)
+        use_nonbond_params, exclusions, virtual_sites)
 
     return gromacs_system
 
 
+def topology_hash(top_file):
+    """Returns SHA1 hash of the topology, including the content of the included files."""
+    fb = FileBuffer()
+    FillFileBuffer(top_file, fb, defines={})
+    return hashlib.sha1('\n'.join(fb.lines)).hexdigest()
+
+
 def storeMolecules(f, molecules, mol=""):
     nrexcl = 0
     line = ''
@@ -570,6 +584,23 @@ def storeAtoms(f, defaults, types, atomtypes,
     return types, masses, charges, num_atoms_molecule, molecule_index, types_tmp
 
 
+def internPairParams(use_pairtypeparams, pair_param_ids, sig, eps):
+    """Returns pair type id for given parameters, new id is created if needed.
+
+    Args:
+        use_pairtypeparams: The dict, key: pairtypeid, value: dict with sig, eps.
+        pair_param_ids: The interning table, key: (sig, eps), value: pairtypeid.
+        sig: The sigma parameter.
+        eps: The epsilon parameter.
+    """
+    pairtypeid = pair_param_ids.get((sig, eps))
+    if pairtypeid is None:
+        pairtypeid = len(use_pairtypeparams)
+        use_pairtypeparams[pairtypeid] = {'sig': sig, 'eps': eps}
+        pair_param_ids[(sig, eps)] = pairtypeid
+    return pairtypeid
+
+
 def storePairs(f, defaults, types, pairtypeparams,
                use_pairtypeparams,
                atomtypeparams, pairs, num_atoms_molecule, num_molecule_copies, molstartindex):
@@ -579,6 +610,7 @@ def storePairs(f, defaults, types, pairtypeparams,
     print('Using fudgeLJ: {}'.format(fudgeLJ))
     combinationrule = defaults['combinationrule']
     types_pairtypeid = {}
+    pair_param_ids = {(v['sig'], v['eps']): k for k, v in use_pairtypeparams.iteritems()}
 
     line = f.readlastline()
     in_section = False
@@ -601,27 +633,23 @@ def storePairs(f, defaults, types, pairtypeparams,
                 lookup = len(tmp) <= 3
                 pid1, pid2 = sorted(map(int, tmp[0:2]))
                 t1, t2 = sorted([types[pid1 - 1], types[pid2 - 1]])
-                pairtypeid = max(use_pairtypeparams) + 1 if use_pairtypeparams else 0
                 if lookup:  # Look for parameters
-                    at1 = atomtypeparams[t1]
-                    at2 = atomtypeparams[t2]
-                    if (t1, t2) in pairtypeparams:
-                        if types_pairtypeid:
-                            pairtypeid = types_pairtypeid.setdefault((t1, t2), max(types_pairtypeid.values()) + 1)
-                        else:
-                            pairtypeid = 0
-                            types_pairtypeid[(t1, t2)] = 0
-                        use_pairtypeparams[pairtypeid] = pairtypeparams[(t1, t2)]
-                    else:
-                        sig_1, eps_1 = at1['sig'], at1['eps']
-                        sig_2, eps_2 = at2['sig'], at2['eps']
-                        eps = fudgeLJ * (eps_1 * eps_2) ** (1.0 / 2.0)
-                        if combinationrule == 2:
-                            sig = 0.5 * (sig_1 + sig_2)
+                    pairtypeid = types_pairtypeid.get((t1, t2))
+                    if pairtypeid is None:
+                        if (t1, t2) in pairtypeparams:
+                            sig = pairtypeparams[(t1, t2)]['sig']
+                            eps = pairtypeparams[(t1, t2)]['eps']
                         else:
-                            sig = (sig_1 * sig_2) ** (1.0 / 2.0)
-                        pairtypeid = max(use_pairtypeparams) + 1 if use_pairtypeparams else 0
-                        use_pairtypeparams[pairtypeid] = {'sig': sig, 'eps': eps}
+                            at1 = atomtypeparams[t1]
+                            at2 = atomtypeparams[t2]
+                            sig_1, eps_1 = at1['sig'], at1['eps']
+                            sig_2, eps_2 = at2['sig'], at2['eps']
+                            eps = fudgeLJ * (eps_1 * eps_2) ** (1.0 / 2.0)
+                            if combinationrule == 2:
+                                sig = 0.5 * (sig_1 + sig_2)
+                            else:
+                                sig = (sig_1 * sig_2) ** (1.0 / 2.0)
+                        pairtypeid = internPairParams(use_pairtypeparams, pair_param_ids, sig, eps)
                         pairtypeparams[(t1, t2)] = use_pairtypeparams[pairtypeid]
                         types_pairtypeid[(t1, t2)] = pairtypeid
                     pairs_tmp.append((pid1, pid2, pairtypeid, cross_pairs))
@@ -636,12 +664,8 @@ def storePairs(f, defaults, types, pairtypeparams,
                     if combinationrule == 1:
                         c6, c12 = sig, eps
                         sig, eps = convertc6c12(c6, c12)
-                    use_pairtypeparams.update({pairtypeid: {
-                        'sig': sig,
-                        'eps': eps
-                    }})
+                    pairtypeid = internPairParams(use_pairtypeparams, pair_param_ids, sig, eps)
                     pairs_tmp.append((pid1, pid2, pairtypeid, cross_pairs))
-                pairtypeid += 1
             line = f.readline()
 
     f.seek(pos)
@@ -731,6 +755,44 @@ def storeBonds(f, types, bondtypes, bondtypeparams, bonds, num_atoms_molecule, \
     return bonds
 
 
+def storeVirtualSites(f, virtual_sites, num_atoms_molecule, num_molecule_copies, molstartindex):
+    """Reads [ virtual_sites3 ] section of the molecule.
+
+    Only the function type 1 is supported, x_s = x_i + a*r_ij + b*r_ik.
+    """
+    vs_tmp = []
+    pos = f.tell()
+    line = f.readlastline()
+
+    line = f.readline().strip()
+    in_section = False
+    while line and 'moleculetype' not in line:
+        if line.startswith('['):
+            in_section = 'virtual_sites3' in line
+            line = f.readline().strip()
+            continue
+        elif line.startswith(';'):
+            line = f.readline().strip()
+            continue
+        else:
+            if in_section:
+                tmp = line.split(';')[0].split()
+                if int(tmp[4]) != 1:
+                    print('Warning! Supported only virtual_sites3 with type 1, given: {}'.format(tmp[4]))
+                else:
+                    site, pid1, pid2, pid3 = map(int, tmp[0:4])
+                    vs_tmp.append((site, pid1, pid2, pid3, float(tmp[5]), float(tmp[6])))
+            line = f.readline().strip()
+
+    f.seek(pos)
+    # extend virtual sites to copies of this molecule
+    for i in range(num_molecule_copies):
+        shift = molstartindex + i * num_atoms_molecule
+        for site, pid1, pid2, pid3, a, b in vs_tmp:
+            virtual_sites.append((site + shift, pid1 + shift, pid2 + shift, pid3 + shift, a, b))
+    return virtual_sites
+
+
 def storeExclusions(exclusions, nrexcl, bonds):
     print('Processing exclusion lists for nrexcl={}'.format(nrexcl))
     if nrexcl > 3:
@@ -908,7 +970,7 @@ def storeDihedrals(f, types, dihedraltypes, dihedraltypeparams, dihedrals,
     return dihedrals
 
 
-def setBondedInteractions(system, bonds, bondtypeparams, ftpl=None):
+def setBondedInteractions(system, bonds, bondtypeparams, ftpl=None, table_tolerance=None):
     ret_list = {}
     for (bid, _), bondlist in bonds.iteritems():
         if ftpl:
@@ -916,7 +978,7 @@ def setBondedInteractions(system, bonds, bondtypeparams, ftpl=None):
         else:
             fpl = espressopp.FixedPairList(system.storage)
         fpl.addBonds(bondlist)
-        bdinteraction = bondtypeparams[bid].createEspressoInteraction(system, fpl)
+        bdinteraction = createBondedInteraction(bondtypeparams[bid], system, fpl, table_tolerance)
         if bdinteraction:
             system.addInteraction(bdinteraction, 'bond_{}'.format(bid))
             ret_list.update({bid: bdinteraction})
@@ -947,7 +1009,7 @@ def setPairInteractions(system, pairs, pairtypeparams, cutoff, ftpl=None):
     return ret_list
 
 
-def setAngleInteractions(system, angles, angletypeparams, ftpl=None):
+def setAngleInteractions(system, angles, angletypeparams, ftpl=None, table_tolerance=None):
     ret_list = {}
 
     for (aid, _), anglelist in angles.iteritems():
@@ -956,14 +1018,14 @@ def setAngleInteractions(system, angles, angletypeparams, ftpl=None):
         else:
             fpl = espressopp.FixedTripleList(system.storage)
         fpl.addTriples(anglelist)
-        angleinteraction = angletypeparams[aid].createEspressoInteraction(system, fpl)
+        angleinteraction = createBondedInteraction(angletypeparams[aid], system, fpl, table_tolerance)
         if angleinteraction:
             system.addInteraction(angleinteraction, 'angle_{}'.format(aid))
             ret_list.update({aid: angleinteraction})
     return ret_list
 
 
-def setDihedralInteractions(system, dihedrals, dihedraltypeparams, ftpl=None):
+def setDihedralInteractions(system, dihedrals, dihedraltypeparams, ftpl=None, table_tolerance=None):
     ret_list = {}
 
     for (did, _), dihedrallist in dihedrals.iteritems():
@@ -972,16 +1034,88 @@ def setDihedralInteractions(system, dihedrals, dihedraltypeparams, ftpl=None):
         else:
             fpl = espressopp.FixedQuadrupleList(system.storage)
         fpl.addQuadruples(dihedrallist)
-        dihedralinteraction = dihedraltypeparams[did].createEspressoInteraction(system, fpl)
+        dihedralinteraction = createBondedInteraction(dihedraltypeparams[did], system, fpl, table_tolerance)
         if dihedralinteraction:
             system.addInteraction(dihedralinteraction, 'dihedral_{}'.format(did))
             ret_list.update({did: dihedralinteraction})
     return ret_list
 
 
+def computeLennardJonesMatrix(atomtypeparams, combinationrule, nonbonded_params=None):
+    """Computes sigma and epsilon for all pairs of atom types.
+
+    The combination rule is applied to the whole matrix at once, then the
+    values defined in [ nonbond_params ] are put on top.
+
+    Returns:
+        The tuple with the array of type ids, the sigma and the epsilon matrices
+        (indexes follow the array of type ids).
+    """
+    type_ids = numpy.array(sorted(atomtypeparams), dtype=numpy.int64)
+    sig = numpy.array([float(atomtypeparams[t]['sig']) for t in type_ids])
+    eps = numpy.array([float(atomtypeparams[t]['eps']) for t in type_ids])
+    if int(combinationrule) == 2:
+        sig_matrix = 0.5*(sig[:, None] + sig[None, :])
+    else:
+        sig_matrix = numpy.sqrt(numpy.outer(sig, sig))
+    eps_matrix = numpy.sqrt(numpy.outer(eps, eps))
+
+    if nonbonded_params:
+        type_index = {t: i for i, t in enumerate(type_ids)}
+        for (type_1, type_2), param in nonbonded_params.iteritems():
+            if type_1 in type_index and type_2 in type_index:
+                i, j = type_index[type_1], type_index[type_2]
+                sig_matrix[i, j] = sig_matrix[j, i] = param['sig']
+                eps_matrix[i, j] = eps_matrix[j, i] = param['eps']
+    return type_ids, sig_matrix, eps_matrix
+
+
+def groupLennardJonesPairs(type_ids, sig_matrix, eps_matrix, pair_mask=None):
+    """Selects type pairs with non-zero Lennard-Jones parameters and groups them by parameters.
+
+    Args:
+        type_ids: The array of type ids.
+        sig_matrix: The matrix with sigma values.
+        eps_matrix: The matrix with epsilon values.
+        pair_mask: The optional boolean matrix, only pairs set to True are taken.
+
+    Returns:
+        The tuple with (N, 2) array of type pairs (type_1 <= type_2), (M, 2) array of distinct
+        (sig, eps) parameters and the array with the index of parameters for each type pair.
+    """
+    mask = numpy.triu((sig_matrix > 0.0) & (eps_matrix > 0.0))
+    if pair_mask is not None:
+        mask &= pair_mask
+    idx_1, idx_2 = numpy.nonzero(mask)
+    type_pairs = numpy.column_stack((type_ids[idx_1], type_ids[idx_2]))
+    pair_params = numpy.column_stack((sig_matrix[idx_1, idx_2], eps_matrix[idx_1, idx_2]))
+    if len(pair_params) == 0:
+        return type_pairs, pair_params, numpy.zeros(0, dtype=numpy.int64)
+    params, param_idx = numpy.unique(
+        pair_params.view([('sig', numpy.float64), ('eps', numpy.float64)]).ravel(),
+        return_inverse=True)
+    params = params.view(numpy.float64).reshape(-1, 2)
+    return type_pairs, params, param_idx
+
+
+def setLennardJonesPotentials(setPotential_fn, type_pairs, params, param_idx, cutoff):
+    """Sets LJ potentials, pairs with the same parameters share single potential object."""
+    potentials = [espressopp.interaction.LennardJones(epsilon=eps, sigma=sig, shift='auto', cutoff=cutoff)
+                  for sig, eps in params]
+    for (type_1, type_2), pot_idx in zip(type_pairs.tolist(), param_idx):
+        setPotential_fn(type1=type_1, type2=type_2, potential=potentials[pot_idx])
+    print('Set LJ interactions for {} type pairs with {} distinct potentials, cutoff {}'.format(
+        len(type_pairs), len(potentials), cutoff))
+    return potentials
+
+
 def setLennardJonesInteractions(system, defaults, atomtypeparams, verletlist, cutoff, nonbonded_params=None,
-                                hadress=False, ftpl=None, table_groups=None):
-    """ Set lennard jones interactions which were read from gromacs based on the atomypes"""
+                                hadress=False, ftpl=None, table_groups=None, used_types=None):
+    """ Set lennard jones interactions which were read from gromacs based on the atomypes
+
+    If used_types is given (e.g. the types of all particles) then the pairs with any type that
+    is not used are not set.
+    """
     if table_groups is None:
         table_groups = []
     if ftpl:
@@ -992,53 +1126,51 @@ def setLennardJonesInteractions(system, defaults, atomtypeparams, verletlist, cu
     else:
         interaction = espressopp.interaction.VerletListLennardJones(verletlist)
 
-    if nonbonded_params is None:
-        nonbonded_params = {}
-
-    combinationrule = int(defaults['combinationrule'])
     print "Setting up Lennard-Jones interactions"
 
-    type_pairs = sorted({
-                            tuple(sorted([type_1, type_2]))
-                            for type_1, pi in atomtypeparams.iteritems()
-                            for type_2, pj in atomtypeparams.iteritems()
-                            if ((pi['atnum'] not in table_groups and pj['atnum'] not in table_groups) and \
-                                (pi.get('atname') not in table_groups and pj.get('atname') not in table_groups))
-                            })
+    type_ids, sig_matrix, eps_matrix = computeLennardJonesMatrix(
+        atomtypeparams, defaults['combinationrule'], nonbonded_params)
+    valid_type = numpy.array([
+        atomtypeparams[t]['particletype'] != 'V' and
+        atomtypeparams[t]['atnum'] not in table_groups and
+        atomtypeparams[t].get('atname') not in table_groups
+        for t in type_ids], dtype=bool)
+    if used_types is not None:
+        # Prune types that are not used by any particle.
+        valid_type &= numpy.isin(type_ids, numpy.unique(used_types))
+    type_pairs, params, param_idx = groupLennardJonesPairs(
+        type_ids, sig_matrix, eps_matrix, numpy.outer(valid_type, valid_type))
     print('Number of pairs: {}'.format(len(type_pairs)))
-    for type_1, type_2 in type_pairs:
-        pi = atomtypeparams[type_1]
-        pj = atomtypeparams[type_2]
-        if pi['particletype'] == 'V' or pj['particletype'] == 'V':
-            print('Skip {}-{}'.format(type_1, type_2))
-            continue
-        param = nonbonded_params.get((type_1, type_2))
-        if param:
-            print 'Using defined non-bonded cross params', param
-            sig, eps = param['sig'], param['eps']
-        else:
-            sig_1, eps_1 = float(pi['sig']), float(pi['eps'])
-            sig_2, eps_2 = float(pj['sig']), float(pj['eps'])
-            if combinationrule == 2:
-                sig = 0.5 * (sig_1 + sig_2)
-                eps = (eps_1 * eps_2) ** (1.0 / 2.0)
-            else:
-                sig = (sig_1 * sig_2) ** (1.0 / 2.0)
-                eps = (eps_1 * eps_2) ** (1.0 / 2.0)
-        if sig > 0.0 and eps > 0.0:
-            print "Setting LJ interaction for", type_1, type_2, "to sig ", sig, "eps", eps, "cutoff", cutoff
-            ljpot = espressopp.interaction.LennardJones(epsilon=eps, sigma=sig, shift='auto', cutoff=cutoff)
-            if ftpl:
-                interaction.setPotentialAT(type1=type_1, type2=type_2, potential=ljpot)
-            else:
-                interaction.setPotential(type1=type_1, type2=type_2, potential=ljpot)
+
+    if ftpl:
+        setLennardJonesPotentials(interaction.setPotentialAT, type_pairs, params, param_idx, cutoff)
+    else:
+        setLennardJonesPotentials(interaction.setPotential, type_pairs, params, param_idx, cutoff)
 
     system.addInteraction(interaction, 'lj')
     return interaction
 
 
+def getChargedTypes(types, charges):
+    """Returns the set of type ids that have non-zero charge on at least one particle.
+
+    Args:
+        types: The list of type ids of all particles.
+        charges: The list of charges of all particles.
+    """
+    types = numpy.asarray(types)
+    charges = numpy.asarray(charges, dtype=numpy.float64)
+    if charges.size == 0:
+        return set()
+    return set(numpy.unique(types[charges != 0.0]).tolist())
+
+
 def setCoulombInteractions(system, verletlist, rc, atomtypeparams,
-                           epsilon1, epsilon2, kappa, ftpl=None):
+                           epsilon1, epsilon2, kappa, ftpl=None, charged_types=None):
+    """Sets reaction-field interactions for the atomistic type pairs.
+
+    If charged_types is given then the pairs with any uncharged type are not set.
+    """
     pref = 138.935485  # we want gromacs units, so this is 1/(4 pi eps_0) ins units of kJ mol^-1 e^-2
 
     at_type_pairs = sorted({
@@ -1047,6 +1179,11 @@ def setCoulombInteractions(system, verletlist, rc, atomtypeparams,
                             for type_2, pj in atomtypeparams.iteritems()
                             if ((pi['particletype'] != 'V' and pj['particletype'] != 'V'))
                             })
+    if charged_types is not None:
+        num_type_pairs = len(at_type_pairs)
+        at_type_pairs = [(type_1, type_2) for type_1, type_2 in at_type_pairs
+                         if type_1 in charged_types and type_2 in charged_types]
+        print('Skip {} coulombic pairs with uncharged types'.format(num_type_pairs - len(at_type_pairs)))
 
     cg_type_pairs = sorted({
                             tuple(sorted([type_1, type_2]))
@@ -1108,9 +1245,9 @@ def setCoulomb14Interactions(system, defaults, onefourlist, rc, types):
     return interaction
 
 
-def setTabulatedInteractions(system, atomtypeparams, vl, cutoff, interaction=None, ftpl=None, table_groups=None):
+def setTabulatedInteractions(system, atomtypeparams, vl, cutoff, interaction=None, ftpl=None, table_groups=None,
+                             tolerance=None):
     """Sets tabulated potential for types that has particletype set to 'V'."""
-    spline_type = 1
     if table_groups is None:
         table_groups = []
 
@@ -1135,12 +1272,9 @@ def setTabulatedInteractions(system, atomtypeparams, vl, cutoff, interaction=Non
             name_1 = atomtypeparams[type_1]['atnum']
             name_2 = atomtypeparams[type_2]['atnum']
             name_1, name_2 = sorted([name_1, name_2])
-            table_name = 'table_{}_{}.pot'.format(name_1, name_2)
-            if not os.path.exists(table_name):
-                orig_table_name = 'table_{}_{}.xvg'.format(name_1, name_2)
-                print('Converting table_{name1}_{name2}.xvg to table_{name1}_{name2}.pot'.format(
-                    name1=name_1, name2=name_2))
-                convertTable(orig_table_name, table_name)
+            table_name, spline_type = getOptimizedTable(
+                'table_{}_{}.xvg'.format(name_1, name_2), 'table_{}_{}.pot'.format(name_1, name_2),
+                tolerance=tolerance, cutoff=cutoff, table_type='nonbonded')
             if ftpl:
                 interaction.setPotentialCG(
                     type1=type_1,
@@ -0,0 +1,282 @@
+"""
+Copyright (C) 2017
+    Jakub Krajniak (jkrajniak at gmail.com)
+
+This file is part of AdResSLab.
+
+AdResSLab is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+AdResSLab is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Conversion and resampling of the tabulated potentials, independent of ESPResSo++.
+
+import hashlib
+import math
+import numpy
+import os
+import re
+from scipy.interpolate import CubicSpline
+
+
+TABLE_CACHE_DIR = '.table_cache'
+
+
+def detectTableType(gro_in_file):
+    """Detects the kind of GROMACS table from the file name (table_b0.xvg, table_a0.xvg, table_d0.xvg).
+
+    Returns:
+        One of 'bond', 'angle', 'dihedral' or 'nonbonded'.
+    """
+    m = re.match(r'^table_([bad])\d+\.xvg$', os.path.basename(gro_in_file))
+    if m is None:
+        return 'nonbonded'
+    return {'b': 'bond', 'a': 'angle', 'd': 'dihedral'}[m.group(1)]
+
+
+def convertTable(gro_in_file, esp_out_file, sigma=1.0, epsilon=1.0, c6=1.0, c12=1.0, table_type=None):
+    """Convert GROMACS tabulated file into ESPResSo++ tabulated file (new file
+    is created). First column of input file can be either distance or angle.
+    For non-bonded files, c6 and c12 can be provided. Default value for sigma, epsilon,
+    c6 and c12 is 1.0. Electrostatics are not taken into account (f and fd columns).
+
+    Args:
+        gro_in_file: the GROMACS tabulated file name (bonded, nonbonded, angle
+            or dihedral).
+        esp_out_file: filename of the ESPResSo++ tabulated file to be written.
+        sigma: optional, depending on whether you want to convert units or not.
+        epsilon: optional, depending on whether you want to convert units or not.
+        c6: optional
+        c12: optional
+        table_type: optional, 'bond', 'angle', 'dihedral' or 'nonbonded'; by default
+            detected with detectTableType.
+    """
+    if table_type is None:
+        table_type = detectTableType(gro_in_file)
+    if table_type not in ('bond', 'angle', 'dihedral', 'nonbonded'):
+        raise ValueError('Unknown table type {}'.format(table_type))
+
+    data = numpy.loadtxt(gro_in_file, comments=['#', '@'], ndmin=2)
+    r = data[:, 0]
+
+    if table_type == 'nonbonded':  # non-bonded has 7 columns
+        # TODO: Skiped columns 1 and 2, electrostatics is not implemented yet.
+        e = c6*data[:, 3] + c12*data[:, 5]  # dispersion and repulsion
+        fd = c6*data[:, 4] + c12*data[:, 6]
+    else:  # bonded has 3 columns
+        e = data[:, 1]  # energy
+        fd = data[:, 2]  # force
+
+    # convert units
+    if table_type in ('angle', 'dihedral'):  # degrees to radians
+        r = numpy.radians(r)
+        fd = fd*180/math.pi
+    else:
+        r = r / sigma
+    e = e / epsilon
+    f = fd*sigma / epsilon
+
+    if table_type == 'angle':
+        keep = (r >= 0) & (r <= math.pi)
+    elif table_type == 'dihedral':
+        keep = (r >= -math.pi) & (r <= math.pi)
+    else:
+        keep = r != 0
+
+    numpy.savetxt(esp_out_file, numpy.column_stack((r, e, f))[keep], fmt='%15.8g')
+
+
+def convertTableCached(gro_in_file, sigma=1.0, epsilon=1.0, c6=1.0, c12=1.0, table_type=None,
+                       cache_dir=None):
+    """Converts GROMACS table with convertTable and keeps the result in the cache.
+
+    The converted file is named by the hash of the input content and of the conversion
+    parameters, so a changed input is always converted again and an unchanged one never.
+
+    Args:
+        gro_in_file: the GROMACS tabulated file name.
+        sigma, epsilon, c6, c12, table_type: see convertTable.
+        cache_dir: optional, the cache directory; by default .table_cache next to the input file.
+
+    Returns:
+        The name of the ESPResSo++ tabulated file.
+    """
+    if table_type is None:
+        table_type = detectTableType(gro_in_file)
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(gro_in_file), TABLE_CACHE_DIR)
+    with open(gro_in_file, 'rb') as fin:
+        table_hash = hashlib.sha1(fin.read())
+    table_hash.update(repr((table_type, float(sigma), float(epsilon), float(c6), float(c12))).encode())
+    esp_out_file = os.path.join(cache_dir, '{}_{}.pot'.format(
+        os.path.splitext(os.path.basename(gro_in_file))[0], table_hash.hexdigest()))
+    if not os.path.exists(esp_out_file):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_out_file = '{}.{}.tmp'.format(esp_out_file, os.getpid())
+        convertTable(gro_in_file, tmp_out_file, sigma, epsilon, c6, c12, table_type)
+        os.rename(tmp_out_file, esp_out_file)
+        print('Converted {} to {}'.format(gro_in_file, esp_out_file))
+    return esp_out_file
+
+
+def getTableFile(gro_in_file, esp_file=None, **kwargs):
+    """Returns ESPResSo++ table for the GROMACS table.
+
+    The esp_file is used only when the GROMACS table does not exist,
+    otherwise the table is taken from convertTableCached.
+    """
+    if os.path.exists(gro_in_file) or esp_file is None:
+        return convertTableCached(gro_in_file, **kwargs)
+    return esp_file
+
+
+def _subsampleTable(data, num_rows, stride, spline_type, tolerance):
+    """Takes every stride-th row of the table and checks the interpolation error at the original rows.
+
+    The grid starts at the first row and ends at the first grid point at or beyond the last
+    of num_rows checked rows, so it stays uniform and covers the whole checked range.
+
+    Args:
+        data: The (r, e, f) table.
+        num_rows: The number of leading rows that have to be reproduced.
+        stride: The stride of the grid in rows.
+        spline_type: 1 - linear, 3 - cubic spline interpolation.
+        tolerance: The allowed error, see optimizeTable.
+
+    Returns:
+        The sub-sampled table or None if it is out of tolerance or does not fit in the table.
+    """
+    last_row = -(-(num_rows - 1) // stride) * stride
+    if last_row >= len(data) or last_row // stride < 3:
+        return None
+    grid = data[:last_row + 1:stride]
+    r, values = data[:num_rows, 0], data[:num_rows, 1:3]
+    if spline_type == 1:
+        approx = numpy.column_stack([numpy.interp(r, grid[:, 0], v) for v in grid[:, 1:3].T])
+    else:
+        approx = CubicSpline(grid[:, 0], grid[:, 1:3], bc_type='natural')(r)
+    if numpy.all(numpy.abs(approx - values) <= tolerance*numpy.maximum(1.0, numpy.abs(values))):
+        return grid
+    return None
+
+
+def _coarsestTable(data, num_rows, spline_type, tolerance):
+    """Returns the sub-sampled table with the largest stride within tolerance, or None.
+
+    The error is not monotonic in the stride, so all strides are checked from the largest one;
+    the stride 1 only drops the rows beyond num_rows.
+    """
+    for stride in range((num_rows - 1) // 3, 0, -1):
+        grid = _subsampleTable(data, num_rows, stride, spline_type, tolerance)
+        if grid is not None:
+            return grid
+    return None
+
+
+def optimizeTable(table_file, tolerance, cutoff=None, cache_dir=None):
+    """Sub-samples ESPResSo++ table onto the coarsest uniform grid that reproduces it within tolerance.
+
+    The grid takes every n-th row of the table, so it keeps the original spacing multiplied
+    by n and the original values. Linear and cubic spline interpolation are tried, the cubic
+    spline is used only if it needs at most half of the points of the linear one. The rows
+    beyond the cutoff are never evaluated and are dropped.
+
+    Args:
+        table_file: ESPResSo++ (r, e, f) table, e.g. from convertTableCached.
+        tolerance: The allowed error of energy and force, relative for values larger than 1,
+            absolute otherwise.
+        cutoff: optional, the cut-off of the interaction.
+        cache_dir: optional, the cache directory; by default the directory of the cached input
+            table or .table_cache next to the input file.
+
+    Returns:
+        The tuple with the name of the table and the interpolation type (1 - linear, 3 - cubic spline).
+    """
+    if cache_dir is None:
+        cache_dir = os.path.dirname(table_file)
+        if os.path.basename(cache_dir) != TABLE_CACHE_DIR:
+            cache_dir = os.path.join(cache_dir, TABLE_CACHE_DIR)
+    with open(table_file, 'rb') as fin:
+        table_hash = hashlib.sha1(fin.read())
+    table_hash.update(repr((float(tolerance), None if cutoff is None else float(cutoff))).encode())
+    out_prefix = os.path.join(cache_dir, '{}_{}'.format(
+        os.path.splitext(os.path.basename(table_file))[0], table_hash.hexdigest()))
+    for spline_type in (1, 3):
+        esp_out_file = '{}_s{}.pot'.format(out_prefix, spline_type)
+        if os.path.exists(esp_out_file):
+            return esp_out_file, spline_type
+
+    data = numpy.loadtxt(table_file, comments=['#', '@'], ndmin=2)
+    num_rows = len(data)
+    if cutoff is not None:
+        num_rows = min(num_rows, numpy.searchsorted(data[:, 0], cutoff) + 1)
+
+    grid_linear = _coarsestTable(data, num_rows, 1, tolerance)
+    grid_cubic = _coarsestTable(data, num_rows, 3, tolerance)
+    if grid_cubic is not None and (grid_linear is None or 2*len(grid_cubic) <= len(grid_linear)):
+        spline_type, grid = 3, grid_cubic
+    elif grid_linear is not None:
+        spline_type, grid = 1, grid_linear
+    else:
+        print('Table {} can not be resampled within tolerance {}'.format(table_file, tolerance))
+        return table_file, 1
+
+    esp_out_file = '{}_s{}.pot'.format(out_prefix, spline_type)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_out_file = '{}.{}.tmp'.format(esp_out_file, os.getpid())
+    numpy.savetxt(tmp_out_file, grid, fmt='%15.8g')
+    os.rename(tmp_out_file, esp_out_file)
+    print('Resampled {} from {} to {} points, interpolation type {}'.format(
+        table_file, len(data), len(grid), spline_type))
+    return esp_out_file, spline_type
+
+
+def getOptimizedTable(gro_in_file, esp_file=None, tolerance=None, cutoff=None, **kwargs):
+    """Returns ESPResSo++ table for the GROMACS table, resampled with optimizeTable.
+
+    Args:
+        gro_in_file, esp_file: see getTableFile.
+        tolerance: optional, the tolerance of optimizeTable, None - the table is not resampled.
+        cutoff: optional, the cut-off of the interaction.
+        kwargs: passed to convertTableCached.
+
+    Returns:
+        The tuple with the name of the table and the interpolation type.
+    """
+    table_file = getTableFile(gro_in_file, esp_file, **kwargs)
+    if tolerance is None:
+        return table_file, 1
+    return optimizeTable(table_file, tolerance, cutoff)
+
+
+def tableRange(table_file, tolerance=1e-8):
+    """Returns the distance beyond which the tabulated non-bonded potential vanishes.
+
+    Args:
+        table_file: ESPResSo++ (r, e, f) or GROMACS (r, f, -f', g, -g', h, -h') table.
+        tolerance: The values with absolute value below it are treated as zero.
+
+    Returns:
+        The first distance after the last non-zero energy or force.
+    """
+    data = numpy.loadtxt(table_file, comments=['#', '@'], ndmin=2)
+    r = data[:, 0]
+    if data.shape[1] >= 7:
+        values = data[:, 3:7]  # dispersion and repulsion columns, as in convertTable
+    else:
+        values = data[:, 1:3]
+    nonzero = numpy.flatnonzero(numpy.any(numpy.abs(values) > tolerance, axis=1))
+    if nonzero.size == 0:
+        return r[0]
+    return r[min(nonzero[-1] + 1, len(r) - 1)]
@@ -18,10 +18,701 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import numpy
+import os
+import time
+from scipy.optimize import nnls
+from scipy.signal import savgol_filter
 
-def set_single_th_force(thdforce, input_conf, tf_new):
-    """Sets single thermodynamic force for all types of CG particles."""
-    for type_id, type_data in input_conf.atomtypeparams.items():
-        if type_data['particletype'] == 'V':
-            print('Thermodynamic force from {} on type {}'.format(tf_new, type_id))
-            thdforce.addForce(itype=3, filename=tf_new, type=type_id)
\ No newline at end of file
+
+class ThermodynamicForce(object):
+    """Sets the thermodynamic force tables of CG types.
+
+    TDforce reads the tables only from files and can neither replace nor remove a table,
+    therefore every set of types has a single table file that is overwritten on each update
+    and registered again with TDforce.addForce.
+    """
+
+    def __init__(self, thdforce, input_conf, file_prefix, itype=3):
+        self.thdforce = thdforce
+        self.file_prefix = file_prefix
+        self.itype = itype
+        self.cg_type_ids = sorted(
+            t for t, d in input_conf.atomtypeparams.items() if d['particletype'] == 'V')
+        self.tables = {}
+
+    def set_file(self, file_name, type_ids=None):
+        """Sets the table from the file on the types (by default on all CG types)."""
+        if type_ids is None:
+            type_ids = self.cg_type_ids
+        for type_id in type_ids:
+            print('Thermodynamic force from {} on type {}'.format(file_name, type_id))
+            self.thdforce.addForce(itype=self.itype, filename=file_name, type=type_id)
+            self.tables[type_id] = file_name
+
+    def set_table(self, table, type_ids=None):
+        """Sets the table (x, rho, F) given as numpy array on the types (by default on all CG types)."""
+        if type_ids is None:
+            type_ids = self.cg_type_ids
+        file_name = '{}_tf_{}.xvg'.format(self.file_prefix, '_'.join(map(str, type_ids)))
+        numpy.savetxt(file_name, table)
+        self.set_file(file_name, type_ids)
+
+
+class TypeDensityProfile(object):
+    """Computes the density profiles of CG types along the x-axis.
+
+    The profiles are relative to the average density of the type, as the ones from XDensity.
+    The positions are gathered once per sample for all profiles.
+
+    Args:
+        configurations: The espressopp.analysis.Configurations object.
+        input_conf: The GROMACS input topology object.
+        type_ids: The dictionary with the name of the profile and the CG type id.
+        box: The box size.
+        bins: The number of bins.
+    """
+
+    def __init__(self, configurations, input_conf, type_ids, box, bins):
+        self.configurations = configurations
+        self.configurations.capacity = 1
+        self.box_x = box[0]
+        self.bins = bins
+        types = numpy.asarray(input_conf.types)
+        self.pids, self.index = _profile_pids(types, {name: [type_id] for name, type_id in type_ids.items()})
+
+    def compute(self):
+        """Returns the dictionary with the name of the profile and the density profile."""
+        self.configurations.gather()
+        conf = self.configurations[0]
+        x = numpy.mod([conf[pid][0] for pid in self.pids], self.box_x)
+        profiles = {}
+        for name, index in self.index.items():
+            counts = numpy.histogram(x[index], bins=self.bins, range=(0.0, self.box_x))[0]
+            profiles[name] = counts * float(self.bins) / index.size
+        return profiles
+
+
+class RadialDensityProfile(object):
+    """Computes the radial density profiles of CG types around the centre of AdResS region.
+
+    The profiles are normalized by the volume of the shells and are relative to the average
+    density of the types. The positions are gathered once per sample for all profiles.
+
+    Args:
+        configurations: The espressopp.analysis.Configurations object.
+        input_conf: The GROMACS input topology object.
+        type_ids: The dictionary with the name of the profile and the list of CG type ids.
+        box: The box size.
+        centre: The centre of AdResS region.
+        bins: The number of shells.
+        dr: The width of the shell.
+    """
+
+    def __init__(self, configurations, input_conf, type_ids, box, centre, bins, dr):
+        self.configurations = configurations
+        self.configurations.capacity = 1
+        self.box = numpy.asarray(box, dtype=numpy.float64)[:3]
+        self.centre = numpy.asarray(centre, dtype=numpy.float64)[:3]
+        self.edges = numpy.arange(bins + 1) * dr
+        shell_volumes = 4.0/3.0*numpy.pi*numpy.diff(self.edges**3)
+        types = numpy.asarray(input_conf.types)
+        self.pids, self.index = _profile_pids(types, type_ids)
+        self.norms = {name: shell_volumes * index.size / numpy.prod(self.box) for name, index in self.index.items()}
+
+    def compute(self):
+        """Returns the dictionary with the name of the profile and the density profile."""
+        self.configurations.gather()
+        conf = self.configurations[0]
+        positions = numpy.array([tuple(conf[pid]) for pid in self.pids])
+        r = numpy.sqrt(numpy.sum(_minimum_image(positions - self.centre, self.box)**2, axis=1))
+        profiles = {}
+        for name, index in self.index.items():
+            counts = numpy.histogram(r[index], bins=self.edges)[0]
+            profiles[name] = counts / self.norms[name]
+        return profiles
+
+
+def _profile_pids(types, type_ids):
+    """Returns the ids of particles of all profiles and the indexes of every profile in them.
+
+    Args:
+        types: The array with the type of every particle.
+        type_ids: The dictionary with the name of the profile and the list of type ids.
+    """
+    masks = {}
+    for name, ids in type_ids.items():
+        masks[name] = numpy.isin(types, ids)
+        if not numpy.any(masks[name]):
+            raise RuntimeError('No particles of type {}'.format(name))
+    selected = numpy.flatnonzero(numpy.any(list(masks.values()), axis=0))
+    index = {name: numpy.flatnonzero(mask[selected]) for name, mask in masks.items()}
+    return selected + 1, index
+
+
+def smooth_density_gradient(rho, ex_idx, hy_idx, window=21, order=5):
+    """Smooths the density profile and computes its gradient in the hybrid region.
+
+    Args:
+        rho: The density profile, starting from the centre of the AdResS region.
+        ex_idx: The index of the end of the explicit region.
+        hy_idx: The index of the end of the hybrid region.
+        window: The window of Savitzky-Golay filter.
+        order: The order of Savitzky-Golay filter.
+
+    Returns:
+        The tuple with the smooth density profile and its gradient (zero outside of the hybrid region).
+    """
+    rho_s = savgol_filter(rho, window, order, mode='nearest')  # Make it smooth
+    drho_s = savgol_filter(rho_s, window, order, deriv=1, mode='nearest')   # Get the force
+    drho_s[:ex_idx-1] = 0.0
+    drho_s[hy_idx+1:] = 0.0
+    return rho_s, drho_s
+
+
+class DensityProfileAccumulator(object):
+    """Accumulates density profiles with block averages, in preallocated arrays.
+
+    For the slab AdResS region both sides of the profile are folded around the centre,
+    the half profile starts at centre_idx-1 as the thermodynamic force table.
+
+    Args:
+        bins: The number of bins of the profile.
+        centre_idx: The bin of the centre of AdResS region, None - the profile is not folded.
+        half_bins: The number of bins of the folded profile (by default centre_idx+1).
+        block_size: The number of samples in a block.
+    """
+
+    state_keys = ('sum', 'num_samples', 'half_sum', 'half_sum2', 'num_blocks')
+
+    def __init__(self, bins, centre_idx=None, half_bins=None, block_size=10):
+        self.bins = bins
+        self.block_size = block_size
+        if centre_idx is None:
+            self.index = numpy.arange(bins)
+            self.mirror = None
+        else:
+            if half_bins is None:
+                half_bins = centre_idx + 1
+            self.index = (centre_idx - 1 + numpy.arange(half_bins)) % bins
+            self.mirror = (centre_idx - numpy.arange(half_bins)) % bins
+        self.sum = numpy.zeros(bins)
+        self.half_sum = numpy.zeros(len(self.index))
+        self.half_sum2 = numpy.zeros(len(self.index))
+        self._block = numpy.zeros(bins)
+        self._half = numpy.zeros(len(self.index))
+        self._tmp = numpy.zeros(len(self.index))
+        self.num_samples = 0
+        self.num_blocks = 0
+        self._block_samples = 0
+
+    def reset(self):
+        for x in (self.sum, self.half_sum, self.half_sum2, self._block):
+            x.fill(0.0)
+        self.num_samples = 0
+        self.num_blocks = 0
+        self._block_samples = 0
+
+    def fold(self, profile, out):
+        """Folds the profile into the half profile out."""
+        numpy.take(profile, self.index, out=out)
+        if self.mirror is not None:
+            numpy.take(profile, self.mirror, out=self._tmp)
+            out += self._tmp
+            out *= 0.5
+        return out
+
+    def add(self, profile):
+        """Adds the sampled profile."""
+        self.sum += profile
+        self._block += profile
+        self.num_samples += 1
+        self._block_samples += 1
+        if self._block_samples == self.block_size:
+            self._block /= self.block_size
+            self.fold(self._block, self._half)
+            self.half_sum += self._half
+            self._half *= self._half
+            self.half_sum2 += self._half
+            self.num_blocks += 1
+            self._block.fill(0.0)
+            self._block_samples = 0
+
+    def mean(self):
+        """Returns the mean profile."""
+        return self.sum / max(self.num_samples, 1)
+
+    def half_mean(self):
+        """Returns the mean folded profile."""
+        return self.fold(self.mean(), numpy.zeros(len(self.index)))
+
+    def half_error(self):
+        """Returns the standard error of the mean folded profile from the block averages."""
+        if self.num_blocks < 2:
+            return numpy.full(len(self.index), numpy.inf)
+        mean = self.half_sum / self.num_blocks
+        variance = numpy.maximum(self.half_sum2 / self.num_blocks - mean**2, 0.0)
+        return numpy.sqrt(variance / (self.num_blocks - 1))
+
+    def get_state(self):
+        return {k: getattr(self, k) for k in self.state_keys}
+
+    def set_state(self, state):
+        for k in self.state_keys:
+            if isinstance(getattr(self, k), numpy.ndarray):
+                getattr(self, k)[:] = state[k]
+            else:
+                setattr(self, k, int(state[k]))
+
+
+class ReplicaProfiles(object):
+    """Pools the density profiles of independent TF replicas through files in a shared directory.
+
+    After every TF step each replica saves the running sums of its profiles and then sums up
+    the profiles of all replicas, so every replica computes the same thermodynamic force.
+    The files of a run are kept in the sub-directory run_id of the exchange directory and are
+    removed by close after the last step. A replica refuses to start if its own files from an
+    earlier (failed) run with the same run_id are still there.
+
+    Args:
+        exchange_dir: The directory shared by all replicas.
+        num_replicas: The number of replicas.
+        replica_id: The id of this replica (0..num_replicas-1).
+        run_id: The id of the run, the same for all replicas.
+        poll_time: How often (in seconds) to check for the profiles of other replicas.
+        timeout: How long (in seconds) to wait for the profiles of other replicas.
+    """
+
+    def __init__(self, exchange_dir, num_replicas, replica_id, run_id, poll_time=1.0, timeout=3600.0):
+        if not 0 <= replica_id < num_replicas:
+            raise RuntimeError('Wrong replica id {} for {} replicas'.format(replica_id, num_replicas))
+        self.exchange_dir = os.path.join(exchange_dir, run_id)
+        if not os.path.exists(self.exchange_dir):
+            try:
+                os.makedirs(self.exchange_dir)
+            except OSError:  # created by other replica
+                pass
+        self.num_replicas = num_replicas
+        self.replica_id = replica_id
+        self.poll_time = poll_time
+        self.timeout = timeout
+        self.last_step = None
+        # The marker of the previous run, nobody waits for it before this replica saves its first step.
+        if os.path.exists(self._done_file_name(replica_id)):
+            os.remove(self._done_file_name(replica_id))
+        own_prefix = 'replica{}_'.format(replica_id)
+        stale_files = [f for f in os.listdir(self.exchange_dir) if f.startswith(own_prefix)]
+        if stale_files:
+            raise RuntimeError('Files of replica {} from earlier run found in {}: {}, use other run id or remove '
+                               'them'.format(replica_id, self.exchange_dir, ', '.join(sorted(stale_files))))
+
+    def _file_name(self, replica_id, step):
+        return os.path.join(self.exchange_dir, 'replica{}_s{}.npz'.format(replica_id, step))
+
+    def _done_file_name(self, replica_id):
+        return os.path.join(self.exchange_dir, 'done{}'.format(replica_id))
+
+    def _wait(self, replica_id, file_name, what, wait_start):
+        while not os.path.exists(file_name):
+            if time.time() - wait_start > self.timeout:
+                raise RuntimeError('Replica {} did not {} within {} s ({} not found)'.format(
+                    replica_id, what, self.timeout, file_name))
+            time.sleep(self.poll_time)
+
+    def pool(self, step, accumulators):
+        """Sums up the accumulated profiles of all replicas.
+
+        Args:
+            step: The TF step.
+            accumulators: The dictionary with the name of the profile and DensityProfileAccumulator,
+                its state is replaced by the pooled one.
+        """
+        names = sorted(accumulators, key=str)
+        data = {}
+        for i, name in enumerate(names):
+            for k, v in accumulators[name].get_state().items():
+                data['{}_{}'.format(k, i)] = v
+        file_name = self._file_name(self.replica_id, step)
+        tmp_file_name = '{}.tmp.npz'.format(file_name)
+        numpy.savez(tmp_file_name, **data)
+        os.rename(tmp_file_name, file_name)
+
+        total = {}
+        wait_start = time.time()
+        for replica_id in range(self.num_replicas):
+            replica_file = self._file_name(replica_id, step)
+            self._wait(replica_id, replica_file, 'save step {}'.format(step), wait_start)
+            replica_data = numpy.load(replica_file)
+            for k in replica_data.files:
+                total[k] = total.get(k, 0) + replica_data[k]
+            replica_data.close()
+        for i, name in enumerate(names):
+            accumulators[name].set_state({k: total['{}_{}'.format(k, i)] for k in DensityProfileAccumulator.state_keys})
+
+        # All replicas have read the previous step before they saved this one.
+        previous_file = self._file_name(self.replica_id, step - 1)
+        if os.path.exists(previous_file):
+            os.remove(previous_file)
+        self.last_step = step
+
+    def close(self):
+        """Removes the files of this replica after the last step.
+
+        Every replica marks that it has read the last step and waits for the others, only then
+        its file of the last step is removed. The marker stays until the next run with the same run_id.
+        """
+        with open(self._done_file_name(self.replica_id), 'w'):
+            pass
+        wait_start = time.time()
+        for replica_id in range(self.num_replicas):
+            self._wait(replica_id, self._done_file_name(replica_id), 'finish', wait_start)
+        if self.last_step is not None:
+            os.remove(self._file_name(self.replica_id, self.last_step))
+
+
+class ThermodynamicForceUpdate(object):
+    """Computes the new thermodynamic force from the gradient of the density profile.
+
+    The schemes are:
+        simple: F_new = F - prefactor * drho.
+        adaptive: as simple, the prefactor grows while the gradient decreases and shrinks otherwise.
+        secant: as simple, the prefactor is the Barzilai-Borwein step from the last two steps.
+        anderson: Anderson mixing of the last history simple steps.
+    """
+
+    schemes = ('simple', 'adaptive', 'secant', 'anderson')
+
+    def __init__(self, scheme='simple', prefactor=1.0, history=5):
+        if scheme not in self.schemes:
+            raise RuntimeError('Unknown TF update scheme {}'.format(scheme))
+        self.scheme = scheme
+        self.prefactor = prefactor
+        self.history = history
+        self.th_forces = []
+        self.gradients = []
+        self.step_prefactor = prefactor
+
+    def update(self, th_force, drho):
+        """Returns the new thermodynamic force.
+
+        Args:
+            th_force: The thermodynamic force used to sample the density profile.
+            drho: The gradient of the sampled density profile.
+        """
+        th_force = numpy.asarray(th_force, dtype=numpy.float64)
+        drho = numpy.asarray(drho, dtype=numpy.float64)
+        self.th_forces = (self.th_forces + [th_force])[-(self.history + 1):]
+        self.gradients = (self.gradients + [drho])[-(self.history + 1):]
+
+        if self.scheme == 'adaptive' and len(self.gradients) > 1:
+            if numpy.linalg.norm(self.gradients[-1]) < numpy.linalg.norm(self.gradients[-2]):
+                self.step_prefactor = min(1.2*self.step_prefactor, 10.0*self.prefactor)
+            else:
+                self.step_prefactor = max(0.5*self.step_prefactor, 0.1*self.prefactor)
+        elif self.scheme == 'secant' and len(self.gradients) > 1:
+            d_force = self.th_forces[-1] - self.th_forces[-2]
+            d_gradient = self.gradients[-1] - self.gradients[-2]
+            denominator = numpy.dot(d_force, d_gradient)
+            if denominator > 0.0:
+                self.step_prefactor = numpy.clip(
+                    numpy.dot(d_force, d_force) / denominator, 0.1*self.prefactor, 10.0*self.prefactor)
+            else:
+                self.step_prefactor = self.prefactor
+        elif self.scheme == 'anderson' and len(self.gradients) > 1:
+            residuals = [-self.prefactor*g for g in self.gradients]
+            d_forces = numpy.diff(self.th_forces, axis=0).T
+            d_residuals = numpy.diff(residuals, axis=0).T
+            gamma = numpy.linalg.lstsq(d_residuals, residuals[-1], rcond=None)[0]
+            return th_force + residuals[-1] - (d_forces + d_residuals).dot(gamma)
+
+        return th_force - self.step_prefactor*drho
+
+
+def _minimum_image(d, box):
+    """Wraps the distance vectors with the minimum image convention."""
+    return d - box * numpy.round(d / box)
+
+
+def get_cg_particles(input_conf):
+    """Returns boolean mask of CG particles (particletype 'V') in the topology."""
+    cg_types = [t for t, d in input_conf.atomtypeparams.items() if d['particletype'] == 'V']
+    return numpy.isin(numpy.asarray(input_conf.types), cg_types)
+
+
+def get_adress_tuples(input_conf):
+    """Assigns the atomistic particles to the CG particles.
+
+    The atomistic particles precede the CG particle they belong to, in the same way
+    as genParticleList builds AdResS tuples.
+
+    Args:
+        input_conf: The GROMACS input topology object.
+
+    Returns:
+        The tuple with the array of CG particle indexes, the array of AT particle indexes and
+        the array with the position of the owner in the CG array for every AT particle.
+        AT particles that follow the last CG particle get the owner len(cg_idx).
+    """
+    is_cg = get_cg_particles(input_conf)
+    cg_idx = numpy.flatnonzero(is_cg)
+    at_idx = numpy.flatnonzero(~is_cg)
+    owner = numpy.searchsorted(cg_idx, at_idx)
+    return cg_idx, at_idx, owner
+
+
+def read_positions(input_conf, gro_file):
+    """Reads positions of all particles from the GRO file.
+
+    The GRO file can contain either all particles or only the atomistic particles; in the
+    latter case the positions of CG particles are left as zeros.
+
+    Args:
+        input_conf: The GROMACS input topology object.
+        gro_file: The files_io.GROFile object.
+
+    Returns:
+        The numpy array with positions of all particles defined in the topology.
+    """
+    num_particles = len(input_conf.types)
+    gro_positions = numpy.array([gro_file.atoms[pid].position for pid in sorted(gro_file.atoms)],
+                                dtype=numpy.float64)
+    if len(gro_positions) == num_particles:
+        return gro_positions
+    is_cg = get_cg_particles(input_conf)
+    if len(gro_positions) != numpy.count_nonzero(~is_cg):
+        raise RuntimeError('Number of particles in {} ({}) does not match topology ({}, AT: {})'.format(
+            gro_file.file_name, len(gro_positions), num_particles, numpy.count_nonzero(~is_cg)))
+    print('Read atomistic-only configuration {}, CG positions will be computed'.format(gro_file.file_name))
+    positions = numpy.zeros((num_particles, 3))
+    positions[~is_cg] = gro_positions
+    return positions
+
+
+def compute_cg_positions(input_conf, positions, box, use_virtual_sites=True):
+    """Computes positions of CG particles from the positions of the atomistic particles.
+
+    By default, the CG particle is placed in the mass-weighted centre of its AdResS tuple.
+    If the CG particle is defined in [ virtual_sites3 ] then the virtual-site formula is used
+    instead. Molecules broken by periodic boundaries are handled with the minimum image convention.
+
+    Args:
+        input_conf: The GROMACS input topology object.
+        positions: The array with positions of all particles.
+        box: The box size.
+        use_virtual_sites: If set to True then virtual-site definitions take precedence.
+
+    Returns:
+        The new array of positions with updated CG particles.
+    """
+    positions = numpy.array(positions, dtype=numpy.float64)
+    box = numpy.asarray(box, dtype=numpy.float64)[:3]
+    cg_idx, at_idx, owner = get_adress_tuples(input_conf)
+    num_cg = len(cg_idx)
+
+    valid = owner < num_cg
+    at_idx, owner = at_idx[valid], owner[valid]
+    if num_cg == 0 or at_idx.size == 0:
+        return positions
+
+    # The first atom of every tuple is the reference for the unwrapping.
+    first = numpy.ones(owner.shape, dtype=bool)
+    first[1:] = owner[1:] != owner[:-1]
+    ref = numpy.zeros((num_cg, 3))
+    ref[owner[first]] = positions[at_idx[first]]
+    d = _minimum_image(positions[at_idx] - ref[owner], box)
+
+    masses = numpy.asarray(input_conf.masses, dtype=numpy.float64)[at_idx]
+    total_mass = numpy.bincount(owner, weights=masses, minlength=num_cg)
+    mass_d = numpy.column_stack([
+        numpy.bincount(owner, weights=masses*d[:, x], minlength=num_cg) for x in range(3)])
+    has_mass = total_mass > 0.0
+    cg_positions = positions[cg_idx]
+    cg_positions[has_mass] = ref[has_mass] + mass_d[has_mass] / total_mass[has_mass, None]
+    positions[cg_idx] = cg_positions
+
+    virtual_sites = getattr(input_conf, 'virtual_sites', None)
+    if use_virtual_sites and virtual_sites:
+        vs = numpy.array(virtual_sites, dtype=numpy.float64)
+        site, pid1, pid2, pid3 = vs[:, :4].astype(numpy.int64).T - 1
+        a, b = vs[:, 4, None], vs[:, 5, None]
+        r_ij = _minimum_image(positions[pid2] - positions[pid1], box)
+        r_ik = _minimum_image(positions[pid3] - positions[pid1], box)
+        positions[site] = positions[pid1] + a*r_ij + b*r_ik
+
+    positions[cg_idx] = numpy.mod(positions[cg_idx], box)
+    return positions
+
+
+def estimate_particle_costs(input_conf, positions, box, centre, adress_ex, adress_hy, use_sphere,
+                            at_cutoff, cg_cutoff):
+    """Estimates the cost of every CG particle as the number of its pair interactions.
+
+    The atomistic pairs are counted in the explicit and hybrid region, the CG pairs
+    in the hybrid and CG region.
+
+    Args:
+        input_conf: The GROMACS input topology object.
+        positions: The array of positions of all particles (see compute_cg_positions).
+        box: The box size.
+        centre: The centre of AdResS region.
+        adress_ex: The size of explicit region.
+        adress_hy: The size of hybrid region.
+        use_sphere: If set to true then the AdResS region is spherical.
+        at_cutoff: The cut-off of atomistic interactions.
+        cg_cutoff: The cut-off of CG interactions.
+
+    Returns:
+        The tuple with the positions of CG particles and their costs.
+    """
+    box = numpy.asarray(box, dtype=numpy.float64)[:3]
+    cg_positions, dist, num_at = _molecule_distances(input_conf, positions, box, centre, use_sphere)
+    volume = numpy.prod(box)
+    at_pairs = numpy.sum(num_at) / volume * 4.0/3.0*numpy.pi*at_cutoff**3
+    cg_pairs = len(num_at) / volume * 4.0/3.0*numpy.pi*cg_cutoff**3
+    costs = (numpy.where(dist < adress_ex + adress_hy, num_at*at_pairs, 0.0) +
+             numpy.where(dist >= adress_ex, cg_pairs, 0.0))
+    return cg_positions, costs
+
+
+def _molecule_distances(input_conf, positions, box, centre, use_sphere):
+    """Returns the positions of CG particles, their distances from the centre and the number of their atoms."""
+    cg_idx, at_idx, owner = get_adress_tuples(input_conf)
+    num_cg = len(cg_idx)
+    num_at = numpy.bincount(owner[owner < num_cg], minlength=num_cg)
+    cg_positions = numpy.asarray(positions, dtype=numpy.float64)[cg_idx]
+    d = _minimum_image(cg_positions - numpy.asarray(centre, dtype=numpy.float64)[:3], box)
+    if use_sphere:
+        dist = numpy.sqrt(numpy.sum(d**2, axis=1))
+    else:
+        dist = numpy.abs(d[:, 0])
+    return cg_positions, dist, num_at
+
+
+def region_cost_features(input_conf, positions, box, centre, adress_ex, adress_hy, use_sphere,
+                         at_cutoff, cg_cutoff):
+    """Counts the work of a single step of AdResS simulation for the given regions.
+
+    Args: see estimate_particle_costs.
+
+    Returns:
+        The dictionary with the estimated number of atomistic pairs (at_pairs), CG pairs (cg_pairs),
+        atoms in the hybrid region (hybrid) and bonded terms (bonded).
+    """
+    box = numpy.asarray(box, dtype=numpy.float64)[:3]
+    _, dist, num_at = _molecule_distances(input_conf, positions, box, centre, use_sphere)
+    volume = numpy.prod(box)
+    at_neighbours = numpy.sum(num_at) / volume * 4.0/3.0*numpy.pi*at_cutoff**3
+    cg_neighbours = len(num_at) / volume * 4.0/3.0*numpy.pi*cg_cutoff**3
+    in_at = dist < adress_ex + adress_hy
+    in_cg = dist >= adress_ex
+    return {
+        'at_pairs': 0.5 * numpy.sum(num_at[in_at]) * at_neighbours,
+        'cg_pairs': 0.5 * numpy.count_nonzero(in_cg) * cg_neighbours,
+        'hybrid': float(numpy.sum(num_at[in_at & in_cg])),
+        'bonded': float(sum(
+            len(x) for type_lists in (input_conf.bondtypes, input_conf.angletypes,
+                                      input_conf.dihedraltypes, input_conf.pairtypes)
+            for x in type_lists.values()))}
+
+
+def node_grid_imbalance(positions, costs, box, node_grid):
+    """Returns the ratio of the largest to the mean cost of the domains of the node grid."""
+    box = numpy.asarray(box, dtype=numpy.float64)[:3]
+    node_grid = numpy.asarray(node_grid)
+    domain = numpy.floor(numpy.mod(positions, box) / (box / node_grid)).astype(numpy.int64)
+    domain = numpy.minimum(domain, node_grid - 1)
+    domain_costs = numpy.bincount(
+        numpy.ravel_multi_index(domain.T, node_grid), weights=costs, minlength=numpy.prod(node_grid))
+    return numpy.max(domain_costs) / max(numpy.mean(domain_costs), 1e-12)
+
+
+def plan_node_grid(positions, costs, box, num_cpus, min_domain_size):
+    """Selects the node grid with the most balanced cost of the domains.
+
+    Among the equally balanced grids the one with the smallest surface of domains is taken.
+
+    Args:
+        positions: The positions of CG particles.
+        costs: The costs of CG particles (see estimate_particle_costs).
+        box: The box size.
+        num_cpus: The number of CPUs.
+        min_domain_size: The smallest allowed size of the domain (cut-off + skin).
+
+    Returns:
+        The tuple with the node grid and the list of (node grid, predicted imbalance) for all
+        allowed node grids.
+    """
+    candidates = []
+    for nx in range(1, num_cpus + 1):
+        for ny in range(1, num_cpus // nx + 1):
+            if num_cpus % (nx*ny):
+                continue
+            node_grid = (nx, ny, num_cpus // (nx*ny))
+            if any(b / n < min_domain_size for b, n in zip(box, node_grid)):
+                continue
+            imbalance = node_grid_imbalance(positions, costs, box, node_grid)
+            surface = sum(box[0]*box[1]*box[2]/b*(n - 1) for b, n in zip(box, node_grid))
+            candidates.append((round(imbalance, 3), surface, node_grid))
+    if not candidates:
+        raise RuntimeError('No node grid for {} CPUs with domains larger than {}'.format(num_cpus, min_domain_size))
+    candidates.sort()
+    return list(candidates[0][2]), [(c[2], c[0]) for c in candidates]
+
+
+class AdressCostModel(object):
+    """Linear model of the wall time of a single step of AdResS simulation.
+
+    The time per step is modelled as
+
+        t = overhead + imbalance / num_cpus * sum_i(coefficient_i * feature_i)
+
+    where the features are counted by region_cost_features and the imbalance is
+    given by node_grid_imbalance. The coefficients are fitted (non-negative least squares)
+    to the time per step measured in a few short benchmark runs.
+    """
+    feature_names = ('at_pairs', 'cg_pairs', 'hybrid', 'bonded')
+
+    def __init__(self, coefficients=None, overhead=0.0):
+        self.coefficients = coefficients
+        self.overhead = overhead
+
+    def _row(self, features, imbalance, num_cpus):
+        return [features[k] * imbalance / float(num_cpus) for k in self.feature_names] + [1.0]
+
+    def fit(self, benchmarks):
+        """Fits the model.
+
+        Args:
+            benchmarks: The list of tuples (features, imbalance, num_cpus, time_per_step).
+
+        Returns:
+            The relative residual of the fit.
+        """
+        if not benchmarks:
+            raise RuntimeError('At least one benchmark is required to fit the cost model')
+        a = numpy.array([self._row(f, imb, n) for f, imb, n, _ in benchmarks])
+        b = numpy.array([t for _, _, _, t in benchmarks], dtype=numpy.float64)
+        # Scale the columns, the number of pairs is many orders of magnitude larger than the overhead.
+        scale = numpy.max(numpy.abs(a), axis=0)
+        scale[scale == 0.0] = 1.0
+        x, residual = nnls(a / scale, b)
+        x /= scale
+        self.coefficients = dict(zip(self.feature_names, x[:-1]))
+        self.overhead = x[-1]
+        return residual / numpy.linalg.norm(b)
+
+    def predict(self, features, imbalance, num_cpus):
+        """Returns the predicted time per step (in seconds)."""
+        if self.coefficients is None:
+            raise RuntimeError('The cost model is not fitted')
+        coefficients = [self.coefficients[k] for k in self.feature_names] + [self.overhead]
+        return numpy.dot(self._row(features, imbalance, num_cpus), coefficients)
+
+    def get_state(self):
+        return {'coefficients': {k: float(v) for k, v in self.coefficients.items()},
+                'overhead': float(self.overhead)}
+
+
+def ns_per_day(time_per_step, dt):
+    """Converts the time per step (s) into the performance in ns/day (dt in ps)."""
+    return 86400.0 / time_per_step * dt / 1000.0
@@ -19,9 +19,18 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
 import collections
+import math
+import operator
 import os
+import resource
+import time
 
 import espressopp  # noqa
+import numpy
+
+import files_io
+import gromacs_topology
+import tools_adress
 
 __doc__ = 'The tools for the simulation.'
 
@@ -78,6 +87,490 @@ def setSystemAnalysis(system, integrator, args, interval, filename_suffix=None,
     return ext_analysis, system_analysis
 
 
+def readTopology(top_file, exclusion_list=None):
+    """Reads GROMACS topology together with the exclusion list.
+
+    The exclusions are kept as int32 .npy file, stamped with the hash of the topology. If the
+    file is missing or stale then the exclusions are generated and the file is written again.
+    Text exclusion lists (two columns) are also accepted but never validated; a missing text
+    list is generated and written.
+
+    Args:
+        top_file: The GROMACS topology file.
+        exclusion_list: The exclusion list file, by default exclusion_<top>.npy
+
+    Returns:
+        The GROMACS input topology object, exclusions are the memory-mapped (N, 2) array.
+    """
+    if exclusion_list is not None and not exclusion_list.endswith('.npy'):
+        if not os.path.exists(exclusion_list):
+            input_conf = gromacs_topology.read(top_file, doRegularExcl=True)
+            exclusions = numpy.asarray(input_conf.exclusions, dtype=numpy.int32).reshape(-1, 2)
+            numpy.savetxt(exclusion_list, exclusions, fmt='%d')
+            print('Save exclusion list: {} ({})'.format(exclusion_list, len(exclusions)))
+            return input_conf._replace(exclusions=exclusions)
+        exclusions = numpy.loadtxt(exclusion_list, dtype=numpy.int32, ndmin=2)
+        print('Read exclusion list from {} (total: {})'.format(exclusion_list, len(exclusions)))
+        input_conf = gromacs_topology.read(top_file, doRegularExcl=False)
+        return input_conf._replace(exclusions=exclusions)
+
+    if exclusion_list is None:
+        exclusion_list = 'exclusion_{}.npy'.format(top_file.split('.')[0])
+    top_hash = gromacs_topology.topology_hash(top_file)
+    exclusions = files_io.read_exclusions(exclusion_list, top_hash)
+    input_conf = gromacs_topology.read(top_file, doRegularExcl=exclusions is None)
+    if exclusions is None:
+        files_io.write_exclusions(exclusion_list, input_conf.exclusions, top_hash)
+        exclusions = files_io.read_exclusions(exclusion_list)
+        print('Save exclusion list: {} ({})'.format(exclusion_list, len(exclusions)))
+    else:
+        print('Read exclusion list from {} (total: {})'.format(exclusion_list, len(exclusions)))
+    return input_conf._replace(exclusions=exclusions)
+
+
+def setExclusions(verletlist, exclusions, chunk_size=100000):
+    """Feeds the Verlet list with excluded pairs in chunks.
+
+    Args:
+        verletlist: The espressopp.VerletList object.
+        exclusions: The (N, 2) array of excluded pairs, can be memory-mapped.
+        chunk_size: The number of pairs passed at once.
+    """
+    for i in range(0, len(exclusions), chunk_size):
+        verletlist.exclude(numpy.asarray(exclusions[i:i+chunk_size]).tolist())
+
+
+def checkCutoffs(box, skin, interaction_cutoffs, num_particles, adress_hy=None, cg_cutoffs=None):
+    """Validates the cut-offs of interactions and reports the estimated number of pairs.
+
+    Every cut-off plus the skin has to fit into the half of the shortest box edge (minimum image
+    convention) and the CG cut-offs can not be larger than the width of the hybrid region.
+    The number of pairs is estimated for the uniform density, it is not measured from
+    the Verlet list (see the Verlet list size in the performance report).
+
+    Args:
+        box: The box size.
+        skin: The skin of the Verlet list.
+        interaction_cutoffs: The dictionary, key is the interaction name and value is the cut-off.
+        num_particles: The number of particles that take part in the interactions.
+        adress_hy: The width of the hybrid region.
+        cg_cutoffs: The dictionary, key is the CG interaction name and value is the cut-off
+            (or the range of the table).
+
+    Returns:
+        The dictionary with the estimated number of pairs for each interaction.
+    """
+    if cg_cutoffs is None:
+        cg_cutoffs = {}
+    half_box = min(box) / 2.0
+    for name, rc in sorted(interaction_cutoffs.items()) + sorted(cg_cutoffs.items()):
+        if rc + skin > half_box:
+            raise RuntimeError('Cut-off of {} ({}) plus skin ({}) is larger than half of the box ({})'.format(
+                name, rc, skin, half_box))
+    for name, rc in sorted(cg_cutoffs.items()):
+        if adress_hy is not None and rc > adress_hy:
+            raise RuntimeError('Cut-off of {} ({}) is larger than the width of hybrid region ({})'.format(
+                name, rc, adress_hy))
+    pair_counts = {}
+    density = num_particles / float(box[0]*box[1]*box[2])
+    for name, rc in sorted(interaction_cutoffs.items()):
+        pair_counts[name] = 0.5 * num_particles * density * 4.0 / 3.0 * math.pi * rc**3
+        print('Interaction {}: cut-off {}, number of pairs (uniform density estimate) {:.0f}'.format(
+            name, rc, pair_counts[name]))
+    return pair_counts
+
+
+def getIntegratorTimers(integrator):
+    """Returns the timers of the integrator averaged over the CPUs."""
+    vv_timers = integrator.getTimers()
+    global_timers = collections.defaultdict(float)
+    for cpu_timer in vv_timers:
+        for k, v in cpu_timer:
+            global_timers[k] += v / len(vv_timers)
+    return dict(global_timers)
+
+
+def getTimersImbalance(cpu_timers, timer_name='timeForce'):
+    """Returns the measured load imbalance, the ratio of the largest to the mean timer over the CPUs.
+
+    If the timer is not found, the sum of all timers of the CPU is used.
+
+    Args:
+        cpu_timers: The timers of every CPU, as returned by integrator.getTimers().
+        timer_name: The name of the timer.
+    """
+    cpu_times = []
+    for cpu_timer in cpu_timers:
+        cpu_timer = dict(cpu_timer)
+        cpu_times.append(cpu_timer.get(timer_name, sum(cpu_timer.values())))
+    if not cpu_times or sum(cpu_times) == 0.0:
+        return None
+    return max(cpu_times) / (sum(cpu_times) / len(cpu_times))
+
+
+def getCpuTime(integrator):
+    """Returns the sum of the timers of the last run of the integrator on the slowest CPU."""
+    return max([sum(v for _, v in cpu_timer) for cpu_timer in integrator.getTimers()] or [0.0])
+
+
+def getTuningKey(particle_types, box, cutoffs, num_cpus):
+    """Returns the key of the tuning cache for the class of the system.
+
+    Args:
+        particle_types: The list with the type of every particle.
+        box: The box size.
+        cutoffs: The list of cut-offs.
+        num_cpus: The number of CPUs.
+    """
+    return 'n{}_box{}_rc{}_cpus{}'.format(
+        ','.join('{}:{}'.format(t, n) for t, n in sorted(collections.Counter(particle_types).items())),
+        ','.join('{:.2f}'.format(x) for x in box),
+        ','.join('{:.3f}'.format(x) for x in cutoffs),
+        num_cpus)
+
+
+def autotuneSkin(system, integrator, verletlist, skins, num_steps, repeats=3):
+    """Runs short segments with every skin and selects the fastest one.
+
+    After every change of the skin the cell grid is adjusted to the new skin.
+    The segments are part of the simulation (equilibration). The time of a segment is taken
+    from the integrator timers of the slowest CPU, the median of repeated segments is used.
+
+    Args:
+        system: The system object.
+        integrator: The integrator.
+        verletlist: The Verlet list.
+        skins: The list of candidate skins.
+        num_steps: The number of steps in a segment.
+        repeats: The number of segments of every skin.
+
+    Returns:
+        The tuple with the fastest skin and the list of (skin, time per step, number of list builds).
+    """
+    results = []
+    for skin in skins:
+        system.skin = skin
+        system.storage.cellAdjust()
+        integrator.run(1)  # the Verlet list is rebuilt for the new skin
+        builds = getattr(verletlist, 'builds', 0)
+        times = []
+        for _ in range(repeats):
+            integrator.run(num_steps)
+            # The timers are reset at the start of every run.
+            times.append(getCpuTime(integrator) / num_steps)
+        time_per_step = float(numpy.median(times))
+        builds = getattr(verletlist, 'builds', 0) - builds
+        print('Autotune skin {}: {:.3e} s/step, {} list builds'.format(skin, time_per_step, builds))
+        results.append((skin, time_per_step, builds))
+    best_skin = min(results, key=operator.itemgetter(1))[0]
+    system.skin = best_skin
+    system.storage.cellAdjust()
+    return best_skin, results
+
+
+class SkinController(object):
+    """Adjusts the skin during the run to keep the time per step at minimum.
+
+    The time per step is the median of window integration blocks. After every window the
+    skin is changed by the relative step; the direction is reversed only if the time per step got
+    worse than the best one since the last reversal by more than twice the noise of the
+    difference, estimated from the spread of the blocks. The step is halved only if the minimum
+    was bracketed, i.e. the time improved before it got worse, and doubled back up after every
+    second improvement. The first direction follows the frequency of Verlet list builds.
+
+    Args:
+        system: The system object.
+        verletlist: The Verlet list.
+        min_skin: The lower bound of skin.
+        max_skin: The upper bound of skin, see getMaxSkin.
+        rel_step: The initial (and largest) relative change of the skin.
+        min_rel_step: The lower bound of the relative change of the skin.
+        window: The number of blocks of a single measurement.
+    """
+
+    def __init__(self, system, verletlist, min_skin, max_skin, rel_step=0.1, min_rel_step=0.01, window=5):
+        if min_skin > max_skin:
+            raise RuntimeError('Lower bound of skin {} is larger than upper bound {}'.format(min_skin, max_skin))
+        self.system = system
+        self.verletlist = verletlist
+        self.min_skin = min_skin
+        self.max_skin = max_skin
+        self.rel_step = rel_step
+        self.max_rel_step = rel_step
+        self.min_rel_step = min_rel_step
+        self.window = window
+        self.direction = 0
+        self.best_cost = None
+        self.improvements = 0
+        self.last_builds = getattr(verletlist, 'builds', 0)
+        self._costs = []
+        self._num_steps = 0
+        self._rel_noises = []
+
+    def update(self, num_steps, run_time):
+        """Updates the skin after the block of num_steps, that took run_time seconds.
+
+        Returns:
+            The new skin.
+        """
+        self._costs.append(run_time / num_steps)
+        self._num_steps += num_steps
+        if len(self._costs) < self.window:
+            return self.system.skin
+        cost = float(numpy.median(self._costs))
+        # The relative standard error of the median from the median absolute deviation, pooled
+        # over all measurements - a single window is too short to estimate it.
+        self._rel_noises.append(
+            1.4826 * 1.25 * float(numpy.median(numpy.abs(numpy.array(self._costs) - cost))) / cost
+            / math.sqrt(self.window))
+        noise = float(numpy.median(self._rel_noises)) * cost
+        builds = getattr(self.verletlist, 'builds', 0)
+        build_frequency = float(builds - self.last_builds) / self._num_steps
+        self.last_builds = builds
+        self._costs = []
+        self._num_steps = 0
+        if self.direction == 0:
+            # Rebuild every few steps - too small skin, no rebuilds at all - too large skin.
+            self.direction = 1 if build_frequency > 0.1 else -1
+            self.best_cost = cost
+        elif cost > self.best_cost + 2.0*math.sqrt(2.0)*noise:
+            self.direction = -self.direction
+            if self.improvements:
+                self.rel_step = max(0.5*self.rel_step, self.min_rel_step)
+            self.improvements = 0
+            self.best_cost = cost
+        elif cost < self.best_cost:
+            # Steady descent - the minimum is farther away than the step.
+            self.improvements += 1
+            if self.improvements % 2 == 0:
+                self.rel_step = min(2.0*self.rel_step, self.max_rel_step)
+            self.best_cost = cost
+
+        skin = self.system.skin * (1.0 + self.direction*self.rel_step)
+        skin = min(max(skin, self.min_skin), self.max_skin)
+        if skin != self.system.skin:
+            self.system.skin = skin
+            self.system.storage.cellAdjust()
+        return skin
+
+
+def getMaxSkin(box, node_grid, cutoff):
+    """Returns the largest skin for which every domain holds at least one cell (cut-off + skin).
+
+    The cut-off plus skin also has to fit into the half of the box (see checkCutoffs).
+    """
+    return min(min(b / float(n), b / 2.0) for b, n in zip(box, node_grid)) - cutoff
+
+
+def setSkin(system, args, verletlist, integrator, particle_types, box, cutoffs, num_cpus):
+    """Sets the skin from --autotune or from the tuning cache, if the skin is not given by --skin.
+
+    Args:
+        system: The system object.
+        args: The command line arguments (skin, autotune, autotune_cache, autotune_skins, autotune_steps,
+            autotune_repeats).
+        verletlist: The Verlet list.
+        integrator: The integrator.
+        particle_types: The list with the type of every particle.
+        box: The box size.
+        cutoffs: The list of cut-offs.
+        num_cpus: The number of CPUs.
+
+    Returns:
+        The skin.
+    """
+    tuning_key = getTuningKey(particle_types, box, cutoffs, num_cpus)
+    if args.autotune:
+        max_skin = min(box) / 2.0 - max(cutoffs)
+        skins = [skin for skin in map(float, args.autotune_skins.split(',')) if skin <= max_skin]
+        if not skins:
+            raise RuntimeError('All skins {} are larger than {} (half of the box minus cut-off)'.format(
+                args.autotune_skins, max_skin))
+        best_skin, results = autotuneSkin(
+            system, integrator, verletlist, skins, args.autotune_steps, args.autotune_repeats)
+        print('Autotune: the fastest skin {}'.format(best_skin))
+        files_io.write_tuning_cache(args.autotune_cache, tuning_key, {'skin': best_skin, 'results': results})
+        return system.skin
+    tuned = files_io.read_tuning_cache(args.autotune_cache, tuning_key)
+    if tuned is None:
+        return system.skin
+    if args.skin is not None:
+        print('Skin {} given by --skin, the tuned skin {} from {} is not used'.format(
+            args.skin, tuned['skin'], args.autotune_cache))
+    else:
+        print('Skin {} from tuning cache {}'.format(tuned['skin'], args.autotune_cache))
+        system.skin = tuned['skin']
+        system.storage.cellAdjust()
+    return system.skin
+
+
+class PerformanceReport(object):
+    """Collects the performance of the run: setup phases, integration time and timers of every CPU.
+
+    The phases are recorded by phase(name) at the end of every phase, the integration blocks by addRun.
+    The integrator resets its timers on every run, therefore addRun has to follow every run and
+    the report holds the timers added up over all of them.
+
+    Args:
+        time0: The start time of the run (by default now).
+    """
+
+    def __init__(self, time0=None):
+        self.time0 = time.time() if time0 is None else time0
+        self.last_time = self.time0
+        self.phases = collections.OrderedDict()
+        self.run_time = 0.0
+        self.num_steps = 0
+        self.cpu_timers = []
+
+    def phase(self, name):
+        """Records the time elapsed since the previous phase as the phase name."""
+        now = time.time()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self.last_time
+        self.last_time = now
+
+    def addRun(self, num_steps, run_time, integrator):
+        """Adds the run of num_steps integrated in run_time seconds and the timers of the integrator."""
+        self.num_steps += num_steps
+        self.run_time += run_time
+        for cpu_id, cpu_timer in enumerate(integrator.getTimers()):
+            if cpu_id == len(self.cpu_timers):
+                self.cpu_timers.append(collections.OrderedDict())
+            for timer_name, value in cpu_timer:
+                self.cpu_timers[cpu_id][timer_name] = self.cpu_timers[cpu_id].get(timer_name, 0.0) + value
+
+    def collect(self, verletlist, dt, **info):
+        """Returns the report.
+
+        Args:
+            verletlist: The Verlet list.
+            dt: The time step.
+            info: The parameters of the run stored with the report (e.g. adress_ex, num_cpus, node_grid).
+
+        Returns:
+            The dictionary with the report.
+        """
+        cpu_timers = self.cpu_timers
+        timers = {}
+        for timer_name in (cpu_timers[0] if cpu_timers else []):
+            values = numpy.array([cpu_timer.get(timer_name, 0.0) for cpu_timer in cpu_timers])
+            mean = values.mean()
+            timers[timer_name] = {
+                'min': float(values.min()), 'max': float(values.max()), 'mean': float(mean),
+                'imbalance': float(values.max() / mean) if mean > 0.0 else None}
+        report = dict(info)
+        time_per_step = self.run_time / self.num_steps if self.num_steps else None
+        report.update({
+            'total_time': time.time() - self.time0,
+            'run_time': self.run_time,
+            'num_steps': self.num_steps,
+            'time_per_step': time_per_step,
+            'steps_per_s': 1.0 / time_per_step if time_per_step else None,
+            'ns_per_day': tools_adress.ns_per_day(time_per_step, dt) if time_per_step else None,
+            'phases': self.phases,
+            'timers': timers,
+            'cpu_timers': cpu_timers,
+            'imbalance': getTimersImbalance(cpu_timers),
+            'verletlist': {'total_size': verletlist.totalSize(), 'builds': getattr(verletlist, 'builds', None)}})
+        return report
+
+    @staticmethod
+    def write(report, output_prefix):
+        """Writes the report as JSON and the timers of every CPU as CSV.
+
+        Returns:
+            The tuple with the names of JSON and CSV files.
+        """
+        json_file = '{}_performance.json'.format(output_prefix)
+        files_io.write_json(json_file, report)
+        csv_file = '{}_timers.csv'.format(output_prefix)
+        timer_names = list(report['timers'])
+        with open(csv_file, 'w') as f:
+            f.write('cpu,{}\n'.format(','.join(timer_names)))
+            for cpu_id, cpu_timer in enumerate(report['cpu_timers']):
+                f.write('{},{}\n'.format(cpu_id, ','.join(str(cpu_timer.get(k, 0.0)) for k in timer_names)))
+        return json_file, csv_file
+
+    @staticmethod
+    def show(report):
+        """Prints the summary of the report."""
+        print('Total time: {:.2f} s, integration: {:.2f} s'.format(report['total_time'], report['run_time']))
+        for phase_name, phase_time in report['phases'].items():
+            print('Phase {}: {:.2f} s'.format(phase_name, phase_time))
+        for timer_name, timer in sorted(report['timers'].items()):
+            print('VV {}: mean {:.2f}, min {:.2f}, max {:.2f}'.format(
+                timer_name, timer['mean'], timer['min'], timer['max']))
+        if report['imbalance'] is not None:
+            print('Load imbalance: {:.3f}'.format(report['imbalance']))
+        print('Total # of neighbors = {}, Verlet list builds = {}'.format(
+            report['verletlist']['total_size'], report['verletlist']['builds']))
+        if report['time_per_step']:
+            print('Integration steps = {}, {:.2f} steps/s, {:.3f} ns/day'.format(
+                report['num_steps'], report['steps_per_s'], report['ns_per_day']))
+
+
+class Heartbeat(object):
+    """Rewrites the JSON status file of the running simulation.
+
+    The file holds the current step, the elapsed time, the instantaneous (since the previous write)
+    and the average speed, ns/day, ETA, the peak memory and the latest energies. It is replaced
+    atomically, so the readers never see a partial file.
+
+    Args:
+        file_name: The status file.
+        total_steps: The total number of steps of the run (used for the ETA).
+        dt: The time step.
+        interval: Write the file every n-th call of update.
+        system: The system object, if set then the energies of the interactions are stored.
+    """
+
+    def __init__(self, file_name, total_steps, dt, interval=1, system=None):
+        self.file_name = file_name
+        self.total_steps = total_steps
+        self.dt = dt
+        self.interval = interval
+        self.system = system
+        self.num_updates = 0
+        self.step = 0
+        self.start_time = self.last_time = time.time()
+        self.last_step = 0
+
+    def update(self, num_steps, **info):
+        """Adds num_steps integrated steps and rewrites the file if it is the time.
+
+        Args:
+            num_steps: The number of steps since the previous call.
+            info: Other values stored in the file (e.g. the step of TF iteration).
+
+        Returns:
+            The status or None if the file was not written.
+        """
+        self.step += num_steps
+        self.num_updates += 1
+        if self.interval <= 0 or self.num_updates % self.interval:
+            return None
+        now = time.time()
+        steps_per_s = self.step / (now - self.start_time)
+        status = dict(info)
+        status.update({
+            'step': self.step,
+            'total_steps': self.total_steps,
+            'elapsed': now - self.start_time,
+            'time': now,
+            'steps_per_s': steps_per_s,
+            'inst_steps_per_s': (self.step - self.last_step) / (now - self.last_time),
+            'ns_per_day': tools_adress.ns_per_day(1.0 / steps_per_s, self.dt),
+            'eta': (self.total_steps - self.step) / steps_per_s if self.total_steps > self.step else 0.0,
+            'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0})
+        if self.system is not None:
+            status['energies'] = {
+                label: interaction.computeEnergy() for label, interaction in self.system.getAllInteractions().items()}
+        files_io.write_json(self.file_name, status)
+        self.last_time = now
+        self.last_step = self.step
+        return status
+
+
 def setLennardJonesInteractions(input_conf, verletlist, cutoff, nonbonded_params=None,
                                 ftpl=None, interaction=None, table_groups=[]):   # NOQA
     """ Set lennard jones interactions which were read from gromacs based on the atomypes
@@ -101,71 +594,44 @@ def setLennardJonesInteractions(input_conf, verletlist, cutoff, nonbonded_params
         else:
             interaction = espressopp.interaction.VerletListLennardJones(verletlist)
 
-    if nonbonded_params is None:
-        nonbonded_params = {}
-
-    combinationrule = int(defaults['combinationrule'])
     print "Setting up Lennard-Jones interactions"
 
-    type_pairs = set()
-    for type_1, pi in atomtypeparams.iteritems():
-        for type_2, pj in atomtypeparams.iteritems():
-            if (pi.get('atnum') in table_groups and pj.get('atnum') in table_groups) or (
-                pi.get('atname') in table_groups and pj.get('atname') in table_groups):
-                continue
-            elif pi['particletype'] != 'V' and pj['particletype'] != 'V':
-                type_pairs.add(tuple(sorted([type_1, type_2])))
-
-    type_pairs = sorted(type_pairs)
-
-    if not type_pairs:
+    type_ids, sig_matrix, eps_matrix = gromacs_topology.computeLennardJonesMatrix(
+        atomtypeparams, defaults['combinationrule'], nonbonded_params)
+    is_at = numpy.array([atomtypeparams[t]['particletype'] != 'V' for t in type_ids], dtype=bool)
+    in_table_atnum = numpy.array([atomtypeparams[t].get('atnum') in table_groups for t in type_ids], dtype=bool)
+    in_table_atname = numpy.array([atomtypeparams[t].get('atname') in table_groups for t in type_ids], dtype=bool)
+    pair_mask = numpy.outer(is_at, is_at) & ~(
+        numpy.outer(in_table_atnum, in_table_atnum) | numpy.outer(in_table_atname, in_table_atname))
+    if not pair_mask.any():
         return None
+    # Prune types that are not used by any particle.
+    is_used = numpy.isin(type_ids, numpy.unique(input_conf.types))
+    pair_mask &= numpy.outer(is_used, is_used)
 
-    print('Number of pairs: {}'.format(len(type_pairs)))
-    for type_1, type_2 in type_pairs:
-        pi = atomtypeparams[type_1]
-        pj = atomtypeparams[type_2]
-        if pi['particletype'] == 'V' or pj['particletype'] == 'V':
-            print('Skip {}-{}'.format(type_1, type_2))
-            continue
-        param = nonbonded_params.get((type_1, type_2))
-        if param:
-            print 'Using defined non-bonded cross params', param
-            sig, eps = param['sig'], param['eps']
-        else:
-            sig_1, eps_1 = float(pi['sig']), float(pi['eps'])
-            sig_2, eps_2 = float(pj['sig']), float(pj['eps'])
-            if combinationrule == 2:
-                sig = 0.5*(sig_1 + sig_2)
-                eps = (eps_1*eps_2)**(1.0/2.0)
-            else:
-                sig = (sig_1*sig_2)**(1.0/2.0)
-                eps = (eps_1*eps_2)**(1.0/2.0)
-        if sig > 0.0 and eps > 0.0:
-            print "Setting LJ interaction for", type_1, type_2, "to sig ", sig, "eps", eps, "cutoff", cutoff
-            ljpot = espressopp.interaction.LennardJones(epsilon=eps, sigma=sig, shift='auto',
-                                                        cutoff=cutoff)
-            if ftpl:
-                interaction.setPotentialAT(type1=type_1, type2=type_2, potential=ljpot)
-            else:
-                interaction.setPotential(type1=type_1, type2=type_2, potential=ljpot)
+    type_pairs, params, param_idx = gromacs_topology.groupLennardJonesPairs(
+        type_ids, sig_matrix, eps_matrix, pair_mask)
+    print('Number of pairs: {} (skip {} without LJ contribution)'.format(
+        len(type_pairs), numpy.count_nonzero(numpy.triu(pair_mask)) - len(type_pairs)))
+    if ftpl:
+        gromacs_topology.setLennardJonesPotentials(
+            interaction.setPotentialAT, type_pairs, params, param_idx, cutoff)
+    else:
+        gromacs_topology.setLennardJonesPotentials(
+            interaction.setPotential, type_pairs, params, param_idx, cutoff)
     return interaction
 
 
-def setTabulatedInteractions(atomtypeparams, cutoff, interaction, table_groups=[]):
-    """Sets tabulated potential for types that has particletype set to 'V'.
+def getTabulatedTypePairs(atomtypeparams, table_groups=[]):
+    """Returns type pairs that use tabulated potential.
 
     Args:
         atomtypeparams: The GROMACS input topology object.
-        interaction: The non-bonded interaction.
-        cutoff: The cut-off for tabulated potential.
-        table_groups: The list of atom types that should use tabulated potential (ignored here).
+        table_groups: The list of atom types that should use tabulated potential.
 
     Returns:
-        The interaction.
+        The sorted list of (type_1, type_2, name_1, name_2), sorted by the names.
     """
-    spline_type = 1  # linear interpolation
-
     type_pairs = set()
     for type_1, v1 in atomtypeparams.iteritems():
         for type_2, v2 in atomtypeparams.iteritems():
@@ -174,20 +640,57 @@ def setTabulatedInteractions(atomtypeparams, cutoff, interaction, table_groups=[
             elif (v1.get('atnum') in table_groups and v2.get('atnum') in table_groups) or (
                 v1.get('atname') in table_groups and v2.get('atname') in table_groups):
                 type_pairs.add(tuple(sorted([type_1, type_2])))
-    if not type_pairs:
-        return None
-    print('Found {} pairs for tabulated interactions'.format(len(type_pairs)))
-    for type_ids in type_pairs:
+    table_pairs = []
+    for type_ids in sorted(type_pairs):
         types_names = sorted([(x, atomtypeparams[x]['atnum']) for x in type_ids], key=lambda z: z[1])
-        name_1 = types_names[0][1]
-        name_2 = types_names[1][1]
-        type_1 = types_names[0][0]
-        type_2 = types_names[1][0]
-        print('Set tabulated potential {}-{} ({}-{})'.format(name_1, name_2, type_1, type_2))
-        table_name = 'table_{}_{}.pot'.format(name_1, name_2)
-        orig_table_name = 'table_{}_{}.xvg'.format(name_1, name_2)
+        table_pairs.append((types_names[0][0], types_names[1][0], types_names[0][1], types_names[1][1]))
+    return table_pairs
+
+
+def getTableCutoff(atomtypeparams, table_groups=[]):
+    """Returns the range of tabulated potentials, read from the .xvg or .pot files.
+
+    Args:
+        atomtypeparams: The GROMACS input topology object.
+        table_groups: The list of atom types that should use tabulated potential.
+
+    Returns:
+        The largest distance with non-zero potential or None if there is no tabulated potential.
+    """
+    table_ranges = []
+    for _, _, name_1, name_2 in getTabulatedTypePairs(atomtypeparams, table_groups):
+        table_name = 'table_{}_{}.xvg'.format(name_1, name_2)
         if not os.path.exists(table_name):
-            espressopp.tools.convert.gromacs.convertTable(orig_table_name, table_name)
+            table_name = 'table_{}_{}.pot'.format(name_1, name_2)
+        table_range = gromacs_topology.tableRange(table_name)
+        print('Range of {}: {}'.format(table_name, table_range))
+        table_ranges.append(table_range)
+    return max(table_ranges) if table_ranges else None
+
+
+def setTabulatedInteractions(atomtypeparams, cutoff, interaction, table_groups=[], tolerance=None):
+    """Sets tabulated potential for types that has particletype set to 'V'.
+
+    Args:
+        atomtypeparams: The GROMACS input topology object.
+        interaction: The non-bonded interaction.
+        cutoff: The cut-off for tabulated potential.
+        table_groups: The list of atom types that should use tabulated potential (ignored here).
+        tolerance: If set then the tables are resampled with this tolerance and cut at the cut-off
+            (see gromacs_topology.optimizeTable).
+
+    Returns:
+        The interaction.
+    """
+    table_pairs = getTabulatedTypePairs(atomtypeparams, table_groups)
+    if not table_pairs:
+        return None
+    print('Found {} pairs for tabulated interactions'.format(len(table_pairs)))
+    for type_1, type_2, name_1, name_2 in table_pairs:
+        print('Set tabulated potential {}-{} ({}-{})'.format(name_1, name_2, type_1, type_2))
+        table_name, spline_type = gromacs_topology.getOptimizedTable(
+            'table_{}_{}.xvg'.format(name_1, name_2), 'table_{}_{}.pot'.format(name_1, name_2),
+            tolerance=tolerance, cutoff=cutoff, table_type='nonbonded')
         interaction.setPotentialCG(
             type1=type_1,
             type2=type_2,
@@ -198,6 +701,23 @@ def setTabulatedInteractions(atomtypeparams, cutoff, interaction, table_groups=[
     return interaction
 
 
+def createThermodynamicForce(system, verletlist, use_sphere=False):
+    """Creates the thermodynamic force extension.
+
+    Args:
+        system: The system object.
+        verletlist: The AdResS Verlet list.
+        use_sphere: If set to true then the force acts along the distance from the centre
+            of spherical AdResS region.
+
+    Returns:
+        The TDforce extension.
+    """
+    if use_sphere:
+        return espressopp.integrator.TDforce(system, verletlist, slab=False)
+    return espressopp.integrator.TDforce(system, verletlist)
+
+
 def genParticleList(input_conf, gro_file, use_charge=False, adress=False, temperature=None):  #NOQA
     """Generates particle list
     Args:
@@ -205,7 +725,8 @@ def genParticleList(input_conf, gro_file, use_charge=False, adress=False, temper
         gro_file: The GRO file.
         use_velocity: If set to true then velocity will be read.
         use_charge: If set to true then charge will be read.
-        adress: If set to true then adress_tuple will be generated.
+        adress: If set to true then adress_tuple will be generated and the positions of CG particles
+            computed from the atomistic particles (the GRO file may contain only AT particles).
         temperature: If temperature is set then velocity will be generated from Maxwell-Boltzmann distr.
     Returns:
         List of property names and particle list.
@@ -231,12 +752,14 @@ def genParticleList(input_conf, gro_file, use_charge=False, adress=False, temper
         adress_tuple = []
         tmptuple = []
         at_id = 0
+        positions = tools_adress.compute_cg_positions(
+            input_conf, tools_adress.read_positions(input_conf, gro_file), gro_file.box)
         for pid in range(num_particles):
             atom_type = input_conf.types[pid]
             particle_type = input_conf.atomtypeparams[atom_type]['particletype']
             tmp = [pid+1,
                    atom_type,
-                   espressopp.Real3D(gro_file.atoms[pid+1].position)]
+                   espressopp.Real3D(*positions[pid])]
             if use_mass:
                 tmp.append(input_conf.masses[pid])
             if use_charge:
@@ -290,16 +813,19 @@ def setPairInteractions(system, input_conf, cutoff, coulomb_cutoff, ftpl=None):
     cross_14_pairs_cg = []
     cross_14_pairs_at = []
 
-    for (pid, cross_bonds), pair_list in pairs.iteritems():
+    # Group pairs with the same parameters, separately for each cross/CG flavour.
+    is_cg_type = {t: d['particletype'] == 'V' for t, d in input_conf.atomtypeparams.iteritems()}
+    pair_groups = collections.OrderedDict()
+    for (pid, cross_bonds), pair_list in sorted(pairs.iteritems()):
         params = pairtypeparams[pid]
-        is_cg = input_conf.atomtypeparams[
-                    input_conf.types[pair_list[0][0] - 1]]['particletype'] == 'V'
-        if is_cg or ftpl is None:
-            fpl = espressopp.FixedPairList(system.storage)
-        else:
-            fpl = espressopp.FixedPairListAdress(system.storage, ftpl)
-        fpl.addBonds(pair_list)
+        for pair in pair_list:
+            is_cg = is_cg_type[input_conf.types[pair[0] - 1]]
+            key = (params['sig'], params['eps'], cross_bonds, is_cg)
+            if key not in pair_groups:
+                pair_groups[key] = (pid, [])
+            pair_groups[key][1].append(pair)
 
+    for (sig, eps, cross_bonds, is_cg), (pid, pair_list) in pair_groups.iteritems():
         if cross_bonds or is_cg:
             if is_cg:
                 cross_14_pairs_cg.extend(pair_list)
@@ -308,23 +834,26 @@ def setPairInteractions(system, input_conf, cutoff, coulomb_cutoff, ftpl=None):
         else:
             static_14_pairs.extend(pair_list)
 
-        if not cross_bonds:
-            is_cg = None
-
-        if params['sig'] > 0.0 and params['eps'] > 0.0:
+        if sig > 0.0 and eps > 0.0:
+            if is_cg or ftpl is None:
+                fpl = espressopp.FixedPairList(system.storage)
+            else:
+                fpl = espressopp.FixedPairListAdress(system.storage, ftpl)
+            fpl.addBonds(pair_list)
             print('Pair interaction {} num pairs: {} sig={} eps={} cutoff={} is_cg={}'.format(
-                params, len(pair_list), params['sig'], params['eps'], cutoff, is_cg))
+                pid, len(pair_list), sig, eps, cutoff, is_cg if cross_bonds else None))
             pot = espressopp.interaction.LennardJones(
-                sigma=params['sig'],
-                epsilon=params['eps'],
+                sigma=sig,
+                epsilon=eps,
                 shift='auto',
                 cutoff=cutoff)
-            if is_cg is None:
+            if not cross_bonds:
                 interaction = espressopp.interaction.FixedPairListLennardJones(system, fpl, pot)
             else:
                 interaction = espressopp.interaction.FixedPairListAdressLennardJones(
                     system, fpl, pot, is_cg)
-            system.addInteraction(interaction, 'lj-14_{}{}'.format(pid, '_cross' if cross_bonds else ''))
+            system.addInteraction(interaction, 'lj-14_{}{}{}'.format(
+                pid, '_cg' if is_cg else '', '_cross' if cross_bonds else ''))
 
     # Set Coulomb14
     if static_14_pairs or cross_14_pairs_cg or cross_14_pairs_at:
@@ -368,19 +897,42 @@ def setPairInteractions(system, input_conf, cutoff, coulomb_cutoff, ftpl=None):
                 interaction_dynamic.setPotential(type1=type_1, type2=type_2, potential=potQQ)
             system.addInteraction(interaction_dynamic, 'coulomb14_at_cross')
 
-def setBondedInteractions(system, input_conf, ftpl):
+
+def consolidateTypes(type_lists, typeparams):
+    """Groups the lists of n-tuples by the parameters of potential.
+
+    Args:
+        type_lists: The dictionary, key is (typeid, cross) and value is the list of n-tuples.
+        typeparams: The dictionary, key is typeid and value is the InteractionType object.
+
+    Returns:
+        The list of (typeid, cross, list of n-tuples), one for each distinct potential and
+        cross flag. The typeid is the lowest id from the group.
+    """
+    groups = collections.OrderedDict()
+    for (tid, cross), tuple_list in sorted(type_lists.iteritems()):
+        key = (typeparams[tid].parametersKey(), cross)
+        if key not in groups:
+            groups[key] = (tid, cross, [])
+        groups[key][2].extend(tuple_list)
+    if len(groups) < len(type_lists):
+        print('Merged {} type lists into {} by the potential parameters'.format(len(type_lists), len(groups)))
+    return groups.values()
+
+
+def setBondedInteractions(system, input_conf, ftpl, table_tolerance=None):
     ret_list = {}
     bonds = input_conf.bondtypes
     bondtypeparams = input_conf.bondtypeparams
 
-    for (bid, cross_bonds), bondlist in bonds.iteritems():
+    for bid, cross_bonds, bondlist in consolidateTypes(bonds, bondtypeparams):
         if ftpl:
             fpl = espressopp.FixedPairListAdress(system.storage, ftpl)
         else:
             fpl = espressopp.FixedPairList(system.storage)
 
         fpl.addBonds(bondlist)
-        bdinteraction = bondtypeparams[bid].createEspressoInteraction(system, fpl)
+        bdinteraction = gromacs_topology.createBondedInteraction(bondtypeparams[bid], system, fpl, table_tolerance)
         if bdinteraction:
             system.addInteraction(bdinteraction, 'bond_{}{}'.format(
                 bid, '_cross' if cross_bonds else ''))
@@ -388,38 +940,38 @@ def setBondedInteractions(system, input_conf, ftpl):
 
     return ret_list
 
-def setAngleInteractions(system, input_conf, ftpl):
+def setAngleInteractions(system, input_conf, ftpl, table_tolerance=None):
     ret_list = {}
     angletypeparams = input_conf.angletypeparams
     angles = input_conf.angletypes
 
-    for (aid, cross_angles), anglelist in angles.iteritems():
+    for aid, cross_angles, anglelist in consolidateTypes(angles, angletypeparams):
         if ftpl:
             ftl = espressopp.FixedTripleListAdress(system.storage, ftpl)
         else:
             ftl = espressopp.FixedTripleList(system.storage)
 
         ftl.addTriples(anglelist)
-        angleinteraction = angletypeparams[aid].createEspressoInteraction(system, ftl)
+        angleinteraction = gromacs_topology.createBondedInteraction(angletypeparams[aid], system, ftl, table_tolerance)
         if angleinteraction:
             system.addInteraction(angleinteraction, 'angle_{}{}'.format(
                 aid, '_cross' if cross_angles else ''))
             ret_list.update({(aid, cross_angles): angleinteraction})
     return ret_list
 
-def setDihedralInteractions(system, input_conf, ftpl):
+def setDihedralInteractions(system, input_conf, ftpl, table_tolerance=None):
     ret_list = {}
     dihedrals = input_conf.dihedraltypes
     dihedraltypeparams = input_conf.dihedraltypeparams
 
-    for (did, cross_dih), dihedrallist in dihedrals.iteritems():
+    for did, cross_dih, dihedrallist in consolidateTypes(dihedrals, dihedraltypeparams):
         if ftpl:
             fql = espressopp.FixedQuadrupleListAdress(system.storage, ftpl)
         else:
             fql = espressopp.FixedQuadrupleList(system.storage)
         fql.addQuadruples(dihedrallist)
 
-        dihedralinteraction = dihedraltypeparams[did].createEspressoInteraction(system, fql)
+        dihedralinteraction = gromacs_topology.createBondedInteraction(dihedraltypeparams[did], system, fql, table_tolerance)
         if dihedralinteraction:
             system.addInteraction(dihedralinteraction, 'dihedral_{}{}'.format(
                 did, '_cross' if cross_dih else ''))
@@ -438,4 +990,69 @@ def renumber_list(input_list, old2new_ids):
         The list of n-tuples with the new ids.
     """
     new_list = [map(old2new_ids.get, t) for t in input_list]
-    return [p for p in new_list if None not in p]
\ No newline at end of file
+    return [p for p in new_list if None not in p]
+
+
+def renumber_array(input_list, old2new_ids):
+    """Create new list of particle n-tuples with the dense lookup array.
+
+    Args:
+        input_list: The input list of n-tuples.
+        old2new_ids: The numpy array, index is the old id and value is the new id (0 if removed).
+
+    Return:
+        The list of n-tuples with the new ids, n-tuples with removed particles are dropped.
+    """
+    ids = numpy.asarray(input_list, dtype=numpy.int64)
+    if ids.size == 0:
+        return []
+    new_ids = old2new_ids[ids]
+    return new_ids[numpy.all(new_ids > 0, axis=1)].tolist()
+
+
+def extract_atomistic(input_conf, part_prop, particle_list):
+    """Removes CG particles and renumbers the atomistic particles.
+
+    Args:
+        input_conf: The GROMACS input topology object.
+        part_prop: The list of particle properties, generated by genParticleList with adress=True.
+        particle_list: The list of particles, generated by genParticleList with adress=True.
+
+    Returns:
+        The tuple with new list of properties, new list of particles and input_conf where
+        bonds, angles, dihedrals, pairs and exclusions use the new ids. The n-tuples that
+        contain CG particles are removed.
+    """
+    part_prop = list(part_prop)
+    index_adrat = part_prop.index('adrat')
+    get_fields = operator.itemgetter(*[i for i in range(len(part_prop)) if i != index_adrat])
+    del part_prop[index_adrat]
+    index_id = part_prop.index('id')
+
+    at_particles = [p for p in particle_list if p.adrat == 1]
+    old_ids = numpy.array([p.id for p in at_particles], dtype=numpy.int64)
+    old2new_ids = numpy.zeros(max(p.id for p in particle_list) + 1, dtype=numpy.int64)
+    old2new_ids[old_ids] = numpy.arange(1, len(old_ids) + 1)
+
+    new_plist = []
+    for new_id, p in enumerate(at_particles, 1):
+        p = list(get_fields(p))
+        p[index_id] = new_id
+        new_plist.append(tuple(p))
+
+    def renumber_dict(input_dict):
+        new_dict = {}
+        for k, v in input_dict.items():
+            new_list = renumber_array(v, old2new_ids)
+            if new_list:
+                new_dict[k] = new_list
+        return new_dict
+
+    input_conf = input_conf._replace(
+        bondtypes=renumber_dict(input_conf.bondtypes),
+        angletypes=renumber_dict(input_conf.angletypes),
+        dihedraltypes=renumber_dict(input_conf.dihedraltypes),
+        pairtypes=renumber_dict(input_conf.pairtypes),
+        exclusions=renumber_array(input_conf.exclusions, old2new_ids))
+
+    return part_prop, new_plist, input_conf
@@ -27,85 +27,7 @@ import espressopp
 import math
 import os
 
-
-def convertTable(gro_in_file, esp_out_file, sigma=1.0, epsilon=1.0, c6=1.0, c12=1.0):
-    """Convert GROMACS tabulated file into ESPResSo++ tabulated file (new file
-    is created). First column of input file can be either distance or angle.
-    For non-bonded files, c6 and c12 can be provided. Default value for sigma, epsilon,
-    c6 and c12 is 1.0. Electrostatics are not taken into account (f and fd columns).
-
-    Args:
-        gro_in_file: the GROMACS tabulated file name (bonded, nonbonded, angle
-            or dihedral).
-        esp_out_file: filename of the ESPResSo++ tabulated file to be written.
-        sigma: optional, depending on whether you want to convert units or not.
-        epsilon: optional, depending on whether you want to convert units or not.
-        c6: optional
-        c12: optional
-    """
-    # determine file type
-    bonded, angle, dihedral = False, False, False
-    if gro_in_file[6] == "b":
-        bonded = True
-    if gro_in_file[6] == "a":
-        angle = True
-        bonded = True
-    if gro_in_file[6] == "d":
-        dihedral = True
-        bonded = True
-
-    fin = open(gro_in_file, 'r')
-    fout = open(esp_out_file, 'w')
-
-    if bonded:  # bonded has 3 columns
-        for line in fin:
-            if line.startswith('#'):
-                continue
-
-            columns = line.split()
-            r = float(columns[0])
-            f = float(columns[1])  # energy
-            fd = float(columns[2])  # force
-
-            # convert units
-            if angle or dihedral:  # degrees to radians
-                r = math.radians(r)
-                fd = fd*180/math.pi
-            else:
-                r = r / sigma
-            e = f / epsilon
-            f = fd*sigma / epsilon
-
-            if (not angle and not dihedral and r != 0) or \
-                (angle and r <= math.pi and r >= 0) or \
-                    (dihedral and r >= -math.pi and r <= math.pi):
-                fout.write("%15.8g %15.8g %15.8g\n" % (r, e, f))
-
-    else:  # non-bonded has 7 columns
-        for line in fin:
-            if line.startswith('#'):  # skip comment lines
-                continue
-            # TODO: Skiped columns 1 and 2, electrostatics is not implemented yet.
-            columns = line.split()
-            r = float(columns[0])
-            g = float(columns[3])  # dispersion
-            gd = float(columns[4])
-            h = float(columns[5])  # repulsion
-            hd = float(columns[6])
-
-            e = c6*g + c12*h
-            f = c6*gd + c12*hd
-
-            # convert units
-            r = r / sigma
-            e = e / epsilon
-            f = f*sigma / epsilon
-
-            if r != 0:  # skip 0
-                fout.write("%15.8g %15.8g %15.8g\n" % (r, e, f))
-
-    fin.close()
-    fout.close()
+from table_helper import *  # NOQA
 
 
 class FileBuffer():
@@ -223,6 +145,9 @@ class InteractionType:
             if k not in other.parameters: return False
             if other.parameters[k]!=v: return False
         return True
+    def parametersKey(self):
+        # interaction types with the same key create the same potential
+        return (self.__class__.__name__, tuple(sorted(self.parameters.items())))
     def createEspressoInteraction(self, system, fpl):
         print("WARNING: could not set up interaction for {}: Espressopp potential not implemented".format(self.parameters))
     def automaticExclusion(self):
@@ -276,13 +201,23 @@ class HarmonicAngleInteractionType(InteractionType):
             return espressopp.interaction.FixedTripleListAngularHarmonic(system, fpl, pot)
 
 
-class TabulatedBondInteractionType(InteractionType):
-    def createEspressoInteraction(self, system, fpl, ftpl=None):
-        spline=1
+class TabulatedInteractionType(InteractionType):
+    # The tables are resampled within the tolerance given to createEspressoInteraction.
+    pass
+
+
+def createBondedInteraction(interaction_type, system, fixed_list, table_tolerance=None):
+    """Creates the interaction of the bonded type, the tables are resampled within table_tolerance."""
+    if isinstance(interaction_type, TabulatedInteractionType):
+        return interaction_type.createEspressoInteraction(system, fixed_list, tolerance=table_tolerance)
+    return interaction_type.createEspressoInteraction(system, fixed_list)
+
+
+class TabulatedBondInteractionType(TabulatedInteractionType):
+    def createEspressoInteraction(self, system, fpl, ftpl=None, tolerance=None):
         fg = "table_b"+str(self.parameters['tablenr'])+".xvg"
-        fe = fg.split(".")[0]+".pot" # name of espressopp file
-        if not os.path.exists(fe):
-            convertTable(fg, fe)
+        fe, spline = getOptimizedTable(fg, fg.split(".")[0]+".pot", tolerance=tolerance,
+                                       table_type='bond') # name of espressopp file
         print('Tabulated bond: {}'.format(fe))
         potTab = espressopp.interaction.Tabulated(itype=spline, filename=fe)
         if ftpl is not None:
@@ -292,13 +227,11 @@ class TabulatedBondInteractionType(InteractionType):
     def automaticExclusion(self):
         return self.parameters['excl']
 
-class TabulatedAngleInteractionType(InteractionType):
-    def createEspressoInteraction(self, system, fpl, ftpl=None):
-        spline=1
+class TabulatedAngleInteractionType(TabulatedInteractionType):
+    def createEspressoInteraction(self, system, fpl, ftpl=None, tolerance=None):
         fg = "table_a"+str(self.parameters['tablenr'])+".xvg"
-        fe = fg.split(".")[0]+".pot" # name of espressopp file
-        if not os.path.exists(fe):
-            convertTable(fg, fe)
+        fe, spline = getOptimizedTable(fg, fg.split(".")[0]+".pot", tolerance=tolerance,
+                                       table_type='angle') # name of espressopp file
         print('Tabulated angular: {}'.format(fe))
         potTab = espressopp.interaction.TabulatedAngular(itype=spline, filename=fe)
         if ftpl is not None:
@@ -306,13 +239,11 @@ class TabulatedAngleInteractionType(InteractionType):
         else:
             return espressopp.interaction.FixedTripleListTabulatedAngular(system, fpl, potTab)
 
-class TabulatedDihedralInteractionType(InteractionType):
-    def createEspressoInteraction(self, system, fpl, ftpl=None):
-        spline = 1
+class TabulatedDihedralInteractionType(TabulatedInteractionType):
+    def createEspressoInteraction(self, system, fpl, ftpl=None, tolerance=None):
         fg = "table_d"+str(self.parameters['tablenr'])+".xvg"
-        fe = fg.split(".")[0]+".pot" # name of espressopp file
-        if not os.path.exists(fe):
-            convertTable(fg, fe)
+        fe, spline = getOptimizedTable(fg, fg.split(".")[0]+".pot", tolerance=tolerance,
+                                       table_type='dihedral') # name of espressopp file
         print('Tabulated dihedral: {}'.format(fe))
         potTab = espressopp.interaction.TabulatedDihedral(itype=spline, filename=fe)
         if ftpl is not None:
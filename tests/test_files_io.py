@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from adresslab import files_io
+
+
+class TestTFHistory(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.history_file = os.path.join(self.tmp_dir, 'sim_tf_history.tfh')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_roundtrip(self):
+        x = numpy.linspace(0.0, 1.0, 5)
+        files_io.append_tf_history(self.history_file, {'tf_x': x, 'rho_s': x*0, 'th_force': x*0}, step=0, name=None)
+        files_io.append_tf_history(self.history_file, {'tf_x': x, 'th_force': 2*x}, step=1, name='W',
+                                   deviation=0.5)
+        records = files_io.read_tf_history(self.history_file)
+        self.assertEqual([r['step'] for r in records], [0, 1])
+        self.assertEqual(records[1]['name'], 'W')
+        self.assertEqual(records[1]['deviation'], 0.5)
+        numpy.testing.assert_allclose(records[1]['th_force'], 2*x)
+
+    def test_truncated_record(self):
+        x = numpy.linspace(0.0, 1.0, 100)
+        for step in range(2):
+            files_io.append_tf_history(self.history_file, {'th_force': x}, step=step)
+        with open(self.history_file, 'rb+') as f:
+            f.truncate(os.path.getsize(self.history_file) - 10)
+        self.assertEqual(len(files_io.read_tf_history(self.history_file)), 1)
+
+    def test_export(self):
+        x = numpy.linspace(0.0, 1.0, 5)
+        files_io.append_tf_history(self.history_file, {'tf_x': x, 'rho_s': x*0, 'th_force': x*0}, step=0)
+        prefix = os.path.join(self.tmp_dir, 'sim')
+        written_files = files_io.export_tf_history(self.history_file, prefix)
+        self.assertEqual(written_files, ['{}_th_s0.xvg'.format(prefix)])
+        self.assertEqual(numpy.loadtxt(written_files[0]).shape, (5, 3))
+
+    def test_backup_file(self):
+        self.assertIsNone(files_io.backup_file(self.history_file))
+        for backup_id in (1, 2):
+            files_io.append_tf_history(self.history_file, {'th_force': numpy.zeros(3)}, step=0)
+            self.assertEqual(files_io.backup_file(self.history_file), '{}.{}'.format(self.history_file, backup_id))
+        self.assertFalse(os.path.exists(self.history_file))
+
+
+class TestExclusions(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.exclusion_file = os.path.join(self.tmp_dir, 'exclusions.npy')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_roundtrip(self):
+        exclusions = [(1, 2), (1, 3), (2, 3)]
+        files_io.write_exclusions(self.exclusion_file, exclusions, 'abc')
+        numpy.testing.assert_array_equal(files_io.read_exclusions(self.exclusion_file, 'abc'), exclusions)
+        numpy.testing.assert_array_equal(files_io.read_exclusions(self.exclusion_file), exclusions)
+
+    def test_stale(self):
+        self.assertIsNone(files_io.read_exclusions(self.exclusion_file, 'abc'))
+        files_io.write_exclusions(self.exclusion_file, [(1, 2)], 'abc')
+        self.assertIsNone(files_io.read_exclusions(self.exclusion_file, 'other'))
+        os.remove('{}.sha1'.format(self.exclusion_file))
+        self.assertIsNone(files_io.read_exclusions(self.exclusion_file, 'abc'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from adresslab import table_helper
+
+
+class TestOptimizeTable(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_table(self, r, e, f):
+        table_file = os.path.join(self.tmp_dir, 'table.pot')
+        numpy.savetxt(table_file, numpy.column_stack((r, e, f)), fmt='%15.8g')
+        return table_file
+
+    def test_smooth_table_is_coarsened(self):
+        r = numpy.linspace(0.002, 2.0, 1000)
+        e = numpy.exp(-r) * numpy.cos(3.0*r)
+        f = numpy.exp(-r) * (numpy.cos(3.0*r) + 3.0*numpy.sin(3.0*r))
+        table_file = self.write_table(r, e, f)
+        tolerance = 1e-3
+
+        out_file, spline_type = table_helper.optimizeTable(table_file, tolerance)
+
+        table = numpy.loadtxt(table_file)
+        out_table = numpy.loadtxt(out_file)
+        self.assertLess(len(out_table), len(table) // 4)
+        # The grid is uniform and made of the original rows.
+        spacing = numpy.diff(out_table[:, 0])
+        numpy.testing.assert_allclose(spacing, spacing[0], rtol=1e-5)
+        self.assertEqual(out_table[0, 0], table[0, 0])
+        self.assertEqual(out_table[-1, 0], table[-1, 0])
+        # The interpolation reproduces the original table within tolerance.
+        if spline_type == 1:
+            approx = numpy.column_stack([numpy.interp(table[:, 0], out_table[:, 0], v) for v in out_table[:, 1:].T])
+        else:
+            approx = table_helper.CubicSpline(out_table[:, 0], out_table[:, 1:], bc_type='natural')(table[:, 0])
+        self.assertTrue(numpy.all(
+            numpy.abs(approx - table[:, 1:]) <= tolerance*numpy.maximum(1.0, numpy.abs(table[:, 1:]))))
+
+    def test_rows_beyond_cutoff_are_dropped(self):
+        r = numpy.linspace(0.002, 2.0, 1000)
+        table_file = self.write_table(r, numpy.random.RandomState(0).normal(size=len(r)), numpy.zeros_like(r))
+
+        out_file, spline_type = table_helper.optimizeTable(table_file, 1e-6, cutoff=1.0)
+
+        out_table = numpy.loadtxt(out_file)
+        self.assertEqual(spline_type, 1)
+        self.assertEqual(len(out_table), numpy.searchsorted(r, 1.0) + 1)
+
+    def test_cached_table_is_reused(self):
+        r = numpy.linspace(0.002, 2.0, 1000)
+        table_file = self.write_table(r, r**2, -2.0*r)
+        out_file, _ = table_helper.optimizeTable(table_file, 1e-3)
+        self.assertEqual(os.path.dirname(out_file), os.path.join(self.tmp_dir, table_helper.TABLE_CACHE_DIR))
+        self.assertEqual(table_helper.optimizeTable(table_file, 1e-3)[0], out_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,282 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy
+
+from adresslab import tools_adress
+
+
+class TestReplicaProfiles(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_replicas(self, steps):
+        """Runs two replicas for the steps and returns their accumulators."""
+        accumulators = []
+        for replica_id in range(2):
+            acc = tools_adress.DensityProfileAccumulator(4, block_size=1)
+            acc.add(numpy.full(4, replica_id + 1.0))
+            accumulators.append({None: acc})
+        replicas = [tools_adress.ReplicaProfiles(self.tmp_dir, 2, i, 'run', poll_time=0.01, timeout=10.0)
+                    for i in range(2)]
+        errors = []
+
+        def run(replica, acc):
+            try:
+                for step in steps:
+                    replica.pool(step, acc)
+                replica.close()
+            except RuntimeError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(r, acc)) for r, acc in zip(replicas, accumulators)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        return accumulators
+
+    def test_pool(self):
+        for acc in self.run_replicas([1]):
+            self.assertEqual(acc[None].num_samples, 2)
+            numpy.testing.assert_allclose(acc[None].mean(), 1.5)
+
+    def test_rerun(self):
+        self.run_replicas([1, 2, 3])
+        # Only the markers of finished replicas are left, the run can be repeated.
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp_dir, 'run'))), ['done0', 'done1'])
+        for acc in self.run_replicas([1]):
+            numpy.testing.assert_allclose(acc[None].mean(), 1.5)
+
+    def test_timeout(self):
+        replica = tools_adress.ReplicaProfiles(self.tmp_dir, 2, 0, 'run', poll_time=0.01, timeout=0.05)
+        acc = tools_adress.DensityProfileAccumulator(4)
+        self.assertRaises(RuntimeError, replica.pool, 1, {None: acc})
+
+    def test_stale_files(self):
+        replica = tools_adress.ReplicaProfiles(self.tmp_dir, 2, 0, 'run', poll_time=0.01, timeout=0.05)
+        acc = tools_adress.DensityProfileAccumulator(4)
+        self.assertRaises(RuntimeError, replica.pool, 1, {None: acc})
+        self.assertRaises(RuntimeError, tools_adress.ReplicaProfiles, self.tmp_dir, 2, 0, 'run')
+        # Other run is not affected.
+        tools_adress.ReplicaProfiles(self.tmp_dir, 2, 0, 'other_run')
+
+
+class FakeConfigurations(object):
+    """Configurations with the positions of particles (ids from 1)."""
+
+    def __init__(self, positions):
+        self.conf = {pid + 1: tuple(p) for pid, p in enumerate(positions)}
+        self.capacity = None
+
+    def gather(self):
+        pass
+
+    def __getitem__(self, i):
+        return self.conf
+
+
+class TopologyMock(object):
+    def __init__(self, types):
+        self.types = types
+
+
+class TestDensityProfiles(unittest.TestCase):
+    def test_type_density_profile(self):
+        rng = numpy.random.RandomState(0)
+        box = [10.0, 5.0, 5.0]
+        positions = rng.uniform(0.0, 1.0, (20000, 3)) * box
+        types = [1, 2] * 10000
+        profile = tools_adress.TypeDensityProfile(
+            FakeConfigurations(positions), TopologyMock(types), {'A': 1, 'B': 2}, box, 10)
+        profiles = profile.compute()
+        self.assertEqual(sorted(profiles), ['A', 'B'])
+        for rho in profiles.values():
+            self.assertAlmostEqual(numpy.mean(rho), 1.0)
+            numpy.testing.assert_allclose(rho, 1.0, atol=0.1)
+
+    def test_radial_density_profile(self):
+        rng = numpy.random.RandomState(0)
+        box = [6.0, 6.0, 6.0]
+        positions = rng.uniform(0.0, 1.0, (50000, 3)) * box
+        types = [1, 2] * 25000
+        profile = tools_adress.RadialDensityProfile(
+            FakeConfigurations(positions), TopologyMock(types), {None: [1, 2], 'B': [2]}, box, [3.0, 3.0, 3.0],
+            10, 0.25)
+        profiles = profile.compute()
+        numpy.testing.assert_allclose(profiles[None][2:], 1.0, atol=0.1)
+        numpy.testing.assert_allclose(profiles['B'][4:], 1.0, atol=0.15)
+
+    def test_missing_type(self):
+        self.assertRaises(RuntimeError, tools_adress.TypeDensityProfile,
+                          FakeConfigurations([[0.0, 0.0, 0.0]]), TopologyMock([1]), {'A': 2}, [1.0, 1.0, 1.0], 10)
+
+
+class TestDensityProfileAccumulator(unittest.TestCase):
+    def test_fold(self):
+        acc = tools_adress.DensityProfileAccumulator(10, centre_idx=5)
+        profile = numpy.arange(10, dtype=numpy.float64)
+        half = acc.fold(profile, numpy.zeros(len(acc.index)))
+        # The half profile starts at centre_idx-1, averaged with its mirror image around the centre.
+        numpy.testing.assert_allclose(half, 0.5*(profile[[4, 5, 6, 7, 8, 9]] + profile[[5, 4, 3, 2, 1, 0]]))
+
+    def test_mean_and_error(self):
+        rng = numpy.random.RandomState(0)
+        acc = tools_adress.DensityProfileAccumulator(6, block_size=5)
+        self.assertTrue(numpy.all(numpy.isinf(acc.half_error())))
+        for _ in range(500):
+            acc.add(1.0 + 0.1*rng.normal(size=6))
+        self.assertEqual(acc.num_blocks, 100)
+        numpy.testing.assert_allclose(acc.mean(), 1.0, atol=0.03)
+        # The error of the mean of 500 samples with the standard deviation 0.1.
+        numpy.testing.assert_allclose(acc.half_error(), 0.1/numpy.sqrt(500), rtol=0.3)
+
+    def test_state(self):
+        acc = tools_adress.DensityProfileAccumulator(4, block_size=2)
+        for i in range(4):
+            acc.add(numpy.full(4, float(i)))
+        other = tools_adress.DensityProfileAccumulator(4, block_size=2)
+        other.set_state(acc.get_state())
+        numpy.testing.assert_allclose(other.mean(), acc.mean())
+        numpy.testing.assert_allclose(other.half_error(), acc.half_error())
+
+
+class WaterMock(object):
+    """Topology of molecules with two atoms followed by the CG particle."""
+
+    def __init__(self, num_molecules):
+        self.atomtypeparams = {1: {'particletype': 'A'}, 2: {'particletype': 'V'}}
+        self.types = [1, 1, 2] * num_molecules
+        self.masses = [1.0, 3.0, 4.0] * num_molecules
+        self.bondtypes = {0: {(1, 2): None}}
+        self.angletypes = {}
+        self.dihedraltypes = {}
+        self.pairtypes = {}
+
+
+def water_positions(num_molecules, box, rng):
+    centres = rng.uniform(0.0, 1.0, (num_molecules, 3)) * box
+    positions = numpy.zeros((3*num_molecules, 3))
+    positions[0::3] = centres
+    positions[1::3] = centres + [0.1, 0.0, 0.0]
+    return positions
+
+
+class TestCgPositions(unittest.TestCase):
+    def test_centre_of_mass(self):
+        box = numpy.array([12.0, 4.0, 4.0])
+        conf = WaterMock(2)
+        positions = numpy.array([[5.0, 1.0, 1.0], [5.4, 1.0, 1.0], [0.0, 0.0, 0.0],
+                                 [11.95, 2.0, 2.0], [0.05, 2.0, 2.0], [0.0, 0.0, 0.0]])
+        cg_positions = tools_adress.compute_cg_positions(conf, positions, box)
+        numpy.testing.assert_allclose(cg_positions[2], [5.3, 1.0, 1.0])
+        # The molecule broken by the periodic boundary.
+        numpy.testing.assert_allclose(cg_positions[5], [0.025, 2.0, 2.0])
+        numpy.testing.assert_allclose(cg_positions[[0, 1, 3, 4]], positions[[0, 1, 3, 4]])
+
+class TestThermodynamicForceUpdate(unittest.TestCase):
+    def converge(self, scheme, num_steps=60):
+        # Linear response of the density gradient to the thermodynamic force.
+        rng = numpy.random.RandomState(0)
+        response = numpy.diag(numpy.linspace(0.3, 1.5, 10))
+        target = rng.normal(size=10)
+        update = tools_adress.ThermodynamicForceUpdate(scheme, prefactor=1.0, history=5)
+        th_force = numpy.zeros(10)
+        for _ in range(num_steps):
+            th_force = update.update(th_force, response.dot(th_force - target))
+        return numpy.max(numpy.abs(th_force - target))
+
+    def test_schemes(self):
+        for scheme in tools_adress.ThermodynamicForceUpdate.schemes:
+            self.assertLess(self.converge(scheme), 1e-6, scheme)
+
+    def test_anderson_faster(self):
+        self.assertLess(self.converge('anderson', 8), self.converge('simple', 8))
+
+    def test_unknown_scheme(self):
+        self.assertRaises(RuntimeError, tools_adress.ThermodynamicForceUpdate, 'newton')
+
+class TestParticleCosts(unittest.TestCase):
+    def test_explicit_region(self):
+        box = numpy.array([12.0, 4.0, 4.0])
+        conf = WaterMock(1000)
+        positions = tools_adress.compute_cg_positions(
+            conf, water_positions(1000, box, numpy.random.RandomState(0)), box)
+        cg_positions, costs = tools_adress.estimate_particle_costs(
+            conf, positions, box, box/2.0, 2.0, 1.0, False, 1.0, 1.0)
+        self.assertEqual(len(costs), 1000)
+        dist = numpy.abs(cg_positions[:, 0] - 6.0)
+        ex_cost, cg_cost = costs[dist < 2.0], costs[dist >= 3.0]
+        numpy.testing.assert_allclose(ex_cost, ex_cost[0])
+        numpy.testing.assert_allclose(cg_cost, cg_cost[0])
+        # Two atoms per molecule, both with twice as many neighbours as the CG particle.
+        self.assertAlmostEqual(ex_cost[0] / cg_cost[0], 4.0)
+
+
+class TestNodeGrid(unittest.TestCase):
+    def setUp(self):
+        rng = numpy.random.RandomState(0)
+        self.box = [8.0, 8.0, 8.0]
+        self.positions = rng.uniform(0.0, 1.0, (8000, 3)) * self.box
+
+    def test_uniform_imbalance(self):
+        imbalance = tools_adress.node_grid_imbalance(
+            self.positions, numpy.ones(8000), self.box, (2, 2, 2))
+        self.assertLess(imbalance, 1.1)
+
+    def test_plan_explicit_slab(self):
+        # The explicit region in the middle of x is ten times more expensive.
+        costs = numpy.where(numpy.abs(self.positions[:, 0] - 4.0) < 1.0, 10.0, 1.0)
+        self.assertGreater(tools_adress.node_grid_imbalance(self.positions, costs, self.box, (4, 1, 1)), 1.5)
+        node_grid, report = tools_adress.plan_node_grid(self.positions, costs, self.box, 4, 1.5)
+        self.assertEqual(node_grid[0], 1)
+        self.assertEqual(report[0][0], tuple(node_grid))
+        self.assertLess(report[0][1], 1.1)
+        self.assertEqual(sorted(r[0] for r in report), [(1, 1, 4), (1, 2, 2), (1, 4, 1), (2, 1, 2),
+                                                         (2, 2, 1), (4, 1, 1)])
+
+    def test_domain_too_small(self):
+        self.assertRaises(
+            RuntimeError, tools_adress.plan_node_grid, self.positions, numpy.ones(8000), self.box, 8, 5.0)
+
+class TestAdressCostModel(unittest.TestCase):
+    def test_region_cost_features(self):
+        box = numpy.array([12.0, 4.0, 4.0])
+        conf = WaterMock(1000)
+        positions = tools_adress.compute_cg_positions(
+            conf, water_positions(1000, box, numpy.random.RandomState(0)), box)
+        small = tools_adress.region_cost_features(conf, positions, box, box/2.0, 1.0, 1.0, False, 1.0, 1.0)
+        large = tools_adress.region_cost_features(conf, positions, box, box/2.0, 3.0, 1.0, False, 1.0, 1.0)
+        self.assertGreater(large['at_pairs'], small['at_pairs'])
+        self.assertLess(large['cg_pairs'], small['cg_pairs'])
+        self.assertEqual(small['bonded'], 1.0)
+
+    def test_fit(self):
+        truth = {'at_pairs': 2e-8, 'cg_pairs': 5e-9, 'hybrid': 1e-7, 'bonded': 1e-8}
+        rng = numpy.random.RandomState(0)
+        benchmarks = []
+        for num_cpus in (1, 2, 4, 8, 1, 2, 4, 8):
+            features = {k: rng.uniform(1e3, 1e6) for k in truth}
+            imbalance = rng.uniform(1.0, 1.5)
+            time_per_step = 1e-4 + imbalance / num_cpus * sum(truth[k]*features[k] for k in truth)
+            benchmarks.append((features, imbalance, num_cpus, time_per_step))
+        model = tools_adress.AdressCostModel()
+        self.assertLess(model.fit(benchmarks), 1e-6)
+        for features, imbalance, num_cpus, time_per_step in benchmarks:
+            self.assertAlmostEqual(model.predict(features, imbalance, num_cpus) / time_per_step, 1.0)
+
+    def test_not_fitted(self):
+        self.assertRaises(RuntimeError, tools_adress.AdressCostModel().predict, {}, 1.0, 1)
+
+    def test_ns_per_day(self):
+        self.assertAlmostEqual(tools_adress.ns_per_day(0.0864, 0.002), 2.0)
+
+if __name__ == '__main__':
+    unittest.main()
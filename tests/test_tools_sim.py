@@ -0,0 +1,147 @@
+import collections
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+try:
+    from adresslab import tools_sim
+except (ImportError, SyntaxError):  # espressopp and Python 2 are required.
+    tools_sim = None
+
+
+class FakeStorage(object):
+    def cellAdjust(self):
+        pass
+
+
+class FakeSystem(object):
+    def __init__(self, skin):
+        self.skin = skin
+        self.storage = FakeStorage()
+
+
+class FakeIntegrator(object):
+    """Integrator that resets its timers at the start of every run, like VelocityVerlet."""
+
+    def __init__(self, system, cost):
+        self.system = system
+        self.cost = cost
+        self.timers = []
+
+    def run(self, num_steps):
+        step_time = self.cost(self.system.skin)
+        self.timers = [[('f', 0.8*step_time*num_steps), ('comm', 0.2*step_time*num_steps)],
+                       [('f', 0.5*step_time*num_steps), ('comm', 0.1*step_time*num_steps)]]
+
+    def getTimers(self):
+        return self.timers
+
+
+@unittest.skipIf(tools_sim is None, 'tools_sim requires espressopp')
+class TestAutotuneSkin(unittest.TestCase):
+    def test_fastest_skin(self):
+        system = FakeSystem(0.3)
+        integrator = FakeIntegrator(system, lambda skin: 1e-3 + (skin - 0.2)**2)
+        best_skin, results = tools_sim.autotuneSkin(system, integrator, None, [0.1, 0.2, 0.3, 0.4], 100)
+        self.assertEqual(best_skin, 0.2)
+        self.assertEqual(system.skin, 0.2)
+        for skin, time_per_step, _ in results:
+            self.assertAlmostEqual(time_per_step, 1e-3 + (skin - 0.2)**2)
+
+
+@unittest.skipIf(tools_sim is None, 'tools_sim requires espressopp')
+class TestCheckCutoffs(unittest.TestCase):
+    def test_pair_counts(self):
+        pair_counts = tools_sim.checkCutoffs(
+            [3.0, 3.0, 3.0], 0.2, {'lj': 1.2, 'coulomb': 0.9}, 2700, 1.5, {'cg': 1.2})
+        self.assertAlmostEqual(pair_counts['coulomb'] / pair_counts['lj'], (0.9 / 1.2)**3)
+
+    def test_half_box(self):
+        self.assertRaises(RuntimeError, tools_sim.checkCutoffs, [5.0, 2.6, 5.0], 0.2, {'lj': 1.2}, 100)
+        self.assertRaises(
+            RuntimeError, tools_sim.checkCutoffs, [5.0, 2.6, 5.0], 0.2, {'lj': 0.9}, 100, 2.0, {'cg': 1.2})
+
+    def test_hybrid_region(self):
+        self.assertRaises(
+            RuntimeError, tools_sim.checkCutoffs, [6.0, 6.0, 6.0], 0.2, {'lj': 0.9}, 100, 1.0, {'cg': 1.2})
+
+    def test_max_skin(self):
+        self.assertAlmostEqual(tools_sim.getMaxSkin([8.0, 4.0, 4.0], [4, 1, 1], 1.2), 0.8)
+        self.assertAlmostEqual(tools_sim.getMaxSkin([8.0, 3.0, 4.0], [1, 1, 1], 1.2), 0.3)
+
+
+class FakeVerletList(object):
+    builds = 3
+
+    def totalSize(self):
+        return 100
+
+
+@unittest.skipIf(tools_sim is None, 'tools_sim requires espressopp')
+class TestPerformanceReport(unittest.TestCase):
+    def test_timers_of_all_runs(self):
+        integrator = FakeIntegrator(FakeSystem(0.3), lambda skin: 1.0)
+        performance = tools_sim.PerformanceReport()
+        for num_steps in (10, 30):
+            integrator.run(num_steps)
+            performance.addRun(num_steps, 0.5, integrator)
+        report = performance.collect(FakeVerletList(), 0.002, num_cpus=2)
+        self.assertEqual(report['num_steps'], 40)
+        self.assertAlmostEqual(report['time_per_step'], 0.025)
+        self.assertAlmostEqual(report['cpu_timers'][0]['f'], 32.0)
+        self.assertAlmostEqual(report['cpu_timers'][1]['comm'], 4.0)
+        self.assertAlmostEqual(report['timers']['f']['max'], 32.0)
+        self.assertAlmostEqual(report['timers']['f']['min'], 20.0)
+        self.assertAlmostEqual(report['imbalance'], 40.0 / 32.0)
+        self.assertEqual(report['num_cpus'], 2)
+
+
+FakeTopology = collections.namedtuple('FakeTopology', ['exclusions'])
+
+
+class FakeGromacsTopology(object):
+    """Replaces the gromacs_topology module, records the calls of read."""
+
+    def __init__(self):
+        self.calls = []
+
+    def read(self, top_file, doRegularExcl=True):
+        self.calls.append(doRegularExcl)
+        return FakeTopology(exclusions=[(1, 2), (1, 3), (2, 3)] if doRegularExcl else [])
+
+    def topology_hash(self, top_file):
+        return 'abc'
+
+
+@unittest.skipIf(tools_sim is None, 'tools_sim requires espressopp')
+class TestReadTopology(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.gromacs_topology = tools_sim.gromacs_topology
+        tools_sim.gromacs_topology = FakeGromacsTopology()
+
+    def tearDown(self):
+        tools_sim.gromacs_topology = self.gromacs_topology
+        shutil.rmtree(self.tmp_dir)
+
+    def check_cache(self, exclusion_list):
+        input_conf = tools_sim.readTopology('topol.top', exclusion_list)
+        numpy.testing.assert_array_equal(input_conf.exclusions, [(1, 2), (1, 3), (2, 3)])
+        self.assertTrue(os.path.exists(exclusion_list))
+        input_conf = tools_sim.readTopology('topol.top', exclusion_list)
+        numpy.testing.assert_array_equal(input_conf.exclusions, [(1, 2), (1, 3), (2, 3)])
+        # The exclusions are generated only once.
+        self.assertEqual(tools_sim.gromacs_topology.calls, [True, False])
+
+    def test_missing_text_list(self):
+        self.check_cache(os.path.join(self.tmp_dir, 'exclusion_topol.list'))
+
+    def test_missing_npy_list(self):
+        self.check_cache(os.path.join(self.tmp_dir, 'exclusion_topol.npy'))
+
+
+if __name__ == '__main__':
+    unittest.main()